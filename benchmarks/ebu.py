@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+''' ebu - Benchmark the EBU-TT parser against the previous BeautifulSoup parser '''
+
+import sys
+import os
+import time
+import tracemalloc
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests"))
+import subconvert
+import reference
+
+#Number of cues in the synthetic subtitles (about two hours)
+CUES = 3000
+#Number of runs, the fastest one counts
+RUNS = 5
+
+# --------------------------------------------------------------------------- #
+def measure(parse, subtitles, runs=RUNS):
+    '''Measure the duration and peak memory of parsing subtitles
+
+    :param parse: Parser returning the intermediate format
+    :type parse: function
+    :param subtitles: Subtitles in the EBU-TT format
+    :type subtitles: string
+    :param runs: Number of runs
+    :type runs: integer
+
+    :returns: Duration of the fastest run in seconds and the peak memory in bytes
+    :rtype: tuple
+    '''
+    best = None
+    for _ in range(runs):
+        start = time.process_time()
+        parse(subtitles)
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    parse(subtitles)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def main():
+    '''Run the benchmark and print the results'''
+    subtitles = reference.generateEBU(CUES)
+    print("{:.0f} kB, {} cues".format(len(subtitles.encode("utf8")) / 1e3, CUES))
+    for name, parse in [("BeautifulSoup", reference.parseEBUSoup), ("lxml iterparse", subconvert.parseEBU)]:
+        elapsed, peak = measure(parse, subtitles)
+        print("{:<15}{:>8.0f} ms{:>8.1f} MB peak".format(name, elapsed * 1e3, peak / 1e6))
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+if __name__ == "__main__":
+    main()
+# ########################################################################### #
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+''' migration - Benchmark the schema migrations and lookups on a synthetic archive database '''
+
+import sys
+import os
+import time
+import random
+import tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tsarchiver
+
+#Number of videos in the synthetic database
+VIDEOS = 100000
+#Number of presenters in the synthetic database
+PRESENTERS = 200
+#Number of lookups per benchmark
+LOOKUPS = 200
+
+#Schema of a database created before the migrations existed
+SCHEMA = [""" CREATE TABLE videos (
+                  id INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE NOT NULL,
+                  datetime TEXT NOT NULL,
+                  showID INTEGER NOT NULL,
+                  presenterID INTEGER,
+                  subtitleID INTEGER,
+                  topics TEXT,
+                  note TEXT,
+                  timstamp INTEGER NOT NULL,
+                  name TEXT NOT NULL,
+                  articleID INTEGER NOT NULL,
+                  videoID TEXT NOT NULL,
+                  checksum TEXT NOT NULL
+              ); """,
+          """ CREATE TABLE subtitles (
+                  id INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE NOT NULL,
+                  raw TEXT NOT NULL,
+                  transcript TEXT NOT NULL,
+                  srt TEXT NOT NULL
+              ); """,
+          """ CREATE TABLE presenters (
+                  id INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE NOT NULL,
+                  name TEXT NOT NULL
+              ); """,
+          """ CREATE TABLE shows (
+                  id INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE NOT NULL,
+                  name TEXT NOT NULL
+              ); """]
+
+# --------------------------------------------------------------------------- #
+def createLegacyDB(path, videos=VIDEOS):
+    '''Create a database with the original schema and fill it with synthetic videos
+
+    Contains a duplicate show and presenter name for the migrations to merge.
+
+    :param path: Path of the database
+    :type path: string
+    :param videos: Number of videos
+    :type videos: integer
+
+    :returns: Connection to the database
+    :rtype: sqlite3.Connection
+    '''
+    dbCon = tsarchiver.connectDB(path)
+    db = dbCon.cursor()
+    for cmd in SCHEMA:
+        db.execute(cmd)
+    db.executemany("INSERT INTO shows(name) VALUES(?);", [("ts20",), ("tt",), ("nm",), ("tt",)])
+    db.executemany("INSERT INTO presenters(name) VALUES(?);", [("p{}".format(i),) for i in range(PRESENTERS)] + [("p1",)])
+    rows = (("2020-01-01 20:00", random.randint(1, 4), random.randint(1, PRESENTERS + 1), None, "", "", 0, "v_{}.mp4".format(i), i, "vid{}".format(i), "") for i in range(videos))
+    db.executemany("INSERT INTO videos(datetime, showID, presenterID, subtitleID, topics, note, timstamp, name, articleID, videoID, checksum) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);", rows)
+    dbCon.commit()
+    return dbCon
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def timeLookups(db, videos=VIDEOS, lookups=LOOKUPS):
+    '''Measure the average duration of the lookups used while archiving
+
+    :param db: Connection to the database
+    :type db: sqlite3.Cursor
+    :param videos: Number of videos in the database
+    :type videos: integer
+    :param lookups: Number of lookups of each kind
+    :type lookups: integer
+
+    :returns: Name and average duration in seconds of each lookup
+    :rtype: list of tuples
+    '''
+    lastCmd = "SELECT MAX(articleID) FROM videos INNER JOIN shows ON shows.id = videos.showID WHERE shows.name=?;"
+    benchmarks = [("checkFilename", lambda: tsarchiver.checkFilename("v_{}.mp4".format(random.randrange(2 * videos)), db)),
+                  ("getLast", lambda: db.execute(lastCmd, ("tt",)).fetchone()),
+                  ("by videoID", lambda: db.execute("SELECT id FROM videos WHERE videoID = ?;", ("vid{}".format(random.randrange(2 * videos)),)).fetchone()),
+                  ("idOrInsert", lambda: tsarchiver.idOrInsert(db, "presenters", "name", "p{}".format(random.randrange(PRESENTERS))))]
+    results = []
+    for name, lookup in benchmarks:
+        start = time.perf_counter()
+        for _ in range(lookups):
+            lookup()
+        results.append((name, (time.perf_counter() - start) / lookups))
+    return results
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def main():
+    '''Run the benchmark and print the results'''
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as directory:
+        dbCon = createLegacyDB(os.path.join(directory, "archive.db"))
+        before = timeLookups(dbCon.cursor())
+        start = time.perf_counter()
+        tsarchiver.updateDB(dbCon)
+        elapsed = time.perf_counter() - start
+        after = timeLookups(dbCon.cursor())
+        dbCon.close()
+    print("{} videos, per lookup:".format(VIDEOS))
+    print("{:<15}{:>12}{:>12}".format("", "before", "after"))
+    for (name, b), (_, a) in zip(before, after):
+        print("{:<15}{:>9.1f} us{:>9.1f} us".format(name, b * 1e6, a * 1e6))
+    print("Migration took {:.2f} s".format(elapsed))
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+if __name__ == "__main__":
+    main()
+# ########################################################################### #
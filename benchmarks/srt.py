@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+''' srt - Benchmark the SRT generation against the previous implementation '''
+
+import sys
+import os
+import time
+import tempfile
+from unittest import mock
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests"))
+import subconvert
+import reference
+
+#Number of cues in the synthetic subtitles (about 16 hours)
+CUES = 20000
+#Number of runs, the fastest one counts
+RUNS = 5
+#Ignore lists to compare
+IGNORE_LISTS = [("no ignore file", None),
+                ("3 phrases", "Studio: Max Mustermann\nUntertitel: NDR\nH.ushalt (2020)\n"),
+                ("201 phrases", "".join("Phrase {}\n".format(i) for i in range(200)) + "Studio: Max Mustermann\n")]
+
+# --------------------------------------------------------------------------- #
+def fastest(func, runs=RUNS):
+    '''Measure the duration of the fastest of several runs
+
+    :param func: Function to measure
+    :type func: function
+    :param runs: Number of runs
+    :type runs: integer
+
+    :returns: Duration in seconds
+    :rtype: float
+    '''
+    best = None
+    for _ in range(runs):
+        start = time.process_time()
+        func()
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def main():
+    '''Run the benchmark and print the results'''
+    subs = subconvert.parseEBU(reference.generateEBU(CUES))
+    print("{} cues".format(CUES))
+    print("{:<16}{:>12}{:>12}".format("", "previous", "current"))
+    loadIgnore = subconvert.loadIgnore
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "subignore.txt")
+        with mock.patch.object(subconvert, "loadIgnore", lambda: loadIgnore(path)):
+            for name, content in IGNORE_LISTS:
+                if content is not None:
+                    with open(path, 'w') as f:
+                        f.write(content)
+                if subconvert.generateSrt(subs) != reference.generateSrtConcat(subs, path):
+                    sys.exit("ERROR: Output of \"{}\" differs".format(name))
+                previous = fastest(lambda: reference.generateSrtConcat(subs, path))
+                current = fastest(lambda: subconvert.generateSrt(subs))
+                print("{:<16}{:>9.0f} ms{:>9.0f} ms".format(name, previous * 1e3, current * 1e3))
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+if __name__ == "__main__":
+    main()
+# ########################################################################### #
@@ -3,49 +3,144 @@
 
 import os
 import sys
-from bs4 import BeautifulSoup
+import io
+import re
+import glob
+import time
+from concurrent.futures import ProcessPoolExecutor
+from lxml import etree
+
+#Namespaces of the EBU-TT elements and attributes
+TT = "{http://www.w3.org/ns/ttml}"
+TTS = "{http://www.w3.org/ns/ttml#styling}"
+XML = "{http://www.w3.org/XML/1998/namespace}"
+#File with phrases, subtitles containing one of them are ignored
+IGNORE_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "subignore.txt")
+#Compiled ignore patterns with the modification time of their file
+IGNORE_CACHE = {}
+#Version of the conversion, increase if a change alters the cues of existing subtitles
+#(the search index of tsarchiver refers to the cues by their number)
+CONVERT_VERSION = 1
+#Line break inside a cue
+BREAK = (None, "\n")
+#File extensions of the supported subtitle formats
+SUBTITLE_FORMATS = (".xml", ".vtt")
+#Number of files converted in parallel (None: number of CPUs)
+WORKERS = None
+
+# --------------------------------------------------------------------------- #
+class Cue:
+    '''A subtitle cue with its times in milliseconds and its lines
+
+    Each line is a tuple of the color (None if not given) and the text,
+    line breaks are separate lines (see BREAK).
+
+    :param begin: Begin in milliseconds
+    :type begin: integer
+    :param end: End in milliseconds
+    :type end: integer
+    :param lines: Lines of the cue
+    :type lines: tuple of tuples
+    '''
+    __slots__ = ("begin", "end", "lines")
+
+    def __init__(self, begin, end, lines):
+        self.begin = begin
+        self.end = end
+        self.lines = lines
+
+    def __repr__(self):
+        return "Cue({}, {}, {!r})".format(self.begin, self.end, self.lines)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def parseTime(timecode, ebu=False):
+    '''Convert a time code to milliseconds
+
+    :param timecode: Time code in the format [H]H:MM:SS.mmm or MM:SS.mmm
+    :type timecode: string
+    :param ebu: Whether to drop the tens digit of the hours, as the EBU-TT subtitles of the tagesschau start at 10:00:00
+    :type ebu: boolean
+
+    :raises: :class:``ValueError: Invalid time code
+
+    :returns: Time in milliseconds
+    :rtype: integer
+    '''
+    parts = timecode.replace(',', '.').split(':')
+    if not 2 <= len(parts) <= 3:
+        raise ValueError("Invalid time code \"{}\"".format(timecode))
+    minutes = int(parts[-2])
+    if len(parts) == 3:
+        hours = int(parts[0]) % 10 if ebu else int(parts[0])
+        minutes += hours * 60
+    return minutes * 60000 + int(float(parts[-1]) * 1000 + 0.5)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def formatTime(ms):
+    '''Format a time in milliseconds as SRT time code
+
+    :param ms: Time in milliseconds
+    :type ms: integer
+
+    :returns: Time code in the format HH:MM:SS,mmm
+    :rtype: string
+    '''
+    return "%02d:%02d:%02d,%03d" % (ms // 3600000, ms // 60000 % 60, ms // 1000 % 60, ms % 1000)
+# ########################################################################### #
 
 # --------------------------------------------------------------------------- #
 def parseEBU(subtitles):
     '''Parse EBU-TT formatted subtitles to intermediate format
 
+    The subtitles are parsed incrementally, each paragraph is discarded once it is converted.
+
     :param subtitles: Subtitles in the EBU-TT format
     :type subtitles: string
 
     :returns: Intermediate format
-    :rtype: list of dictionaries
+    :rtype: list of :class:`Cue`
     '''
     colors = {}
     subs = []
-    ebutt = BeautifulSoup(subtitles, "html.parser")
-    #Get colors
-    for style in ebutt.find("tt:styling").find_all("tt:style"):
-        if "tts:color" in style.attrs:
-            colors[style.attrs["xml:id"]] = style.attrs["tts:color"]
-    #Loop through
-    for p in ebutt.find("tt:div").find_all("tt:p"):
-        #Get begin and end times
-        attrs = p.attrs
-        begin = attrs["begin"].replace('.', ',')
-        if not begin.startswith("0"):
-            begin = '0' + begin[1:]
-        end = attrs["end"].replace('.', ',')
-        if not end.startswith("0"):
-            end = '0' + begin[1:]
-        sub = {"begin" : begin, "end" : end}
-        #Loop through items inside p
-        items = p.findChildren()
-        lines = []
-        for item in items:
-            #span element: text
-            if "span" in item.name:
-                lines.append({"color" : colors[item.attrs["style"]], "text" : item.text})
-            #br: insert line break
-            elif "br" in item.name:
-                lines.append({"text" : "\n"})
-        if lines:
-            sub["lines"] = lines
-            subs.append(sub)
+    source = io.BytesIO(subtitles.encode("utf8"))
+    depth = 0
+    tags = (TT + "div", TT + "styling", TT + "p")
+    for event, elem in etree.iterparse(source, events=("start", "end"), tag=tags, encoding="utf-8", recover=True):
+        #Only the paragraphs inside the first div are converted
+        if elem.tag == TT + "div":
+            if event == "start":
+                depth += 1
+            else:
+                depth -= 1
+                if not depth:
+                    break
+            continue
+        if event != "end":
+            continue
+        #Get colors
+        if elem.tag == TT + "styling":
+            for style in elem.iter(TT + "style"):
+                if TTS + "color" in style.attrib:
+                    colors[style.get(XML + "id")] = style.get(TTS + "color")
+        elif elem.tag == TT + "p" and depth:
+            #Loop through elements inside p
+            lines = []
+            for item in elem.iterdescendants(etree.Element):
+                name = item.tag.rpartition("}")[2]
+                #span element: text
+                if "span" in name:
+                    lines.append((colors[item.get("style")], "".join(item.itertext())))
+                #br: insert line break
+                elif "br" in name:
+                    lines.append(BREAK)
+            if lines:
+                subs.append(Cue(parseTime(elem.attrib["begin"], True), parseTime(elem.attrib["end"], True), tuple(lines)))
+            #Free converted paragraphs
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
 
     return subs
 # ########################################################################### #
@@ -58,93 +153,182 @@ def parseVTT(subtitles):
     :type subtitles: string
 
     :returns: Intermediate format
-    :rtype: list of dictionaries
+    :rtype: list of :class:`Cue`
     '''
     subs = []
     lines = []
-    begin = ""
-    end = ""
-    for line in subtitles.splitlines():
+    begin = None
+    end = None
+    for line in subtitles.splitlines() + ["Sub"]:
         #Ignore header
         if line == "WEBVTT":
             continue
         #Ignore empty lines
         if not line:
             continue
-        #If line starts with Sub, save previous sub if any
+        #If line starts with Sub, save previous sub if any (the last line is added to save the last sub)
         if line.startswith("Sub"):
-            if lines and begin and end:
-                subs.append({"begin" : begin, "end" : end, "lines" : lines})
+            if lines and begin is not None and end is not None:
+                subs.append(Cue(begin, end, tuple(lines)))
             lines = []
-            begin = ""
-            end = ""
+            begin = None
+            end = None
             continue
         #Get time codes
         if "-->" in line:
             [begin, end] = line.split("-->", 1)
-            begin = begin.strip().replace('.', ',')
-            if not begin.startswith("0"):
-                begin = '0' + begin[1:]
-            end = end.strip().replace('.', ',')
-            if not end.startswith("0"):
-                end = '0' + begin[1:]
+            begin = parseTime(begin.strip())
+            end = parseTime(end.split()[0])
             continue
         #Normal line
         #If already a line in this block, add line break
         if lines:
-            lines.append({"text" : "\n"})
-        lines.append({"text" : line})
+            lines.append(BREAK)
+        lines.append((None, line))
 
     return subs
 # ########################################################################### #
 
+# --------------------------------------------------------------------------- #
+def shiftCues(subs, offset):
+    '''Shift all cues by an offset
+
+    Cues which would end before the start are dropped, cues which would begin before it are cut.
+
+    :param subs: Intermediate format
+    :type subs: list of :class:`Cue`
+    :param offset: Offset in milliseconds (negative to shift towards the start)
+    :type offset: integer
+
+    :returns: Shifted cues
+    :rtype: list of :class:`Cue`
+    '''
+    return [Cue(max(0, c.begin + offset), c.end + offset, c.lines) for c in subs if c.end + offset > 0]
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def mergeCues(subs, gap=0):
+    '''Merge consecutive cues with identical lines
+
+    :param subs: Intermediate format
+    :type subs: list of :class:`Cue`
+    :param gap: Maximum time in milliseconds between two cues to merge them
+    :type gap: integer
+
+    :returns: Merged cues
+    :rtype: list of :class:`Cue`
+    '''
+    merged = []
+    for c in subs:
+        if merged and merged[-1].lines == c.lines and c.begin - merged[-1].end <= gap:
+            merged[-1] = Cue(merged[-1].begin, max(merged[-1].end, c.end), c.lines)
+        else:
+            merged.append(c)
+    return merged
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def dropOverlaps(subs):
+    '''Sort cues by their begin and drop cues which begin before the previous one ends
+
+    :param subs: Intermediate format
+    :type subs: list of :class:`Cue`
+
+    :returns: Cues without overlaps
+    :rtype: list of :class:`Cue`
+    '''
+    kept = []
+    for c in sorted(subs, key=lambda c: c.begin):
+        if not kept or c.begin >= kept[-1].end:
+            kept.append(c)
+    return kept
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def editCues(subs, shift=0, merge=False, noOverlaps=False):
+    '''Drop overlapping cues, merge identical cues and shift the cues, in this order
+
+    :param subs: Intermediate format
+    :type subs: list of :class:`Cue`
+    :param shift: Offset in milliseconds, see :func:`shiftCues`
+    :type shift: integer
+    :param merge: Whether to merge consecutive identical cues
+    :type merge: boolean
+    :param noOverlaps: Whether to drop overlapping cues
+    :type noOverlaps: boolean
+
+    :returns: Edited cues
+    :rtype: list of :class:`Cue`
+    '''
+    if noOverlaps:
+        subs = dropOverlaps(subs)
+    if merge:
+        subs = mergeCues(subs)
+    if shift:
+        subs = shiftCues(subs, shift)
+    return subs
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def loadIgnore(path=IGNORE_FILE):
+    '''Get a compiled pattern matching any of the phrases in the ignore file
+
+    The pattern is cached and only compiled again if the modification time of the file changes.
+
+    :param path: Path of the file with one phrase to ignore per line
+    :type path: string
+
+    :returns: Pattern matching subtitle lines to ignore or None if there is nothing to ignore
+    :rtype: re.Pattern
+    '''
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    cached = IGNORE_CACHE.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    try:
+        with open(path, 'r') as f:
+            excludeLines = [l.strip() for l in f.readlines()]
+    except IOError:
+        return None
+    pattern = re.compile("|".join(re.escape(e) for e in excludeLines)) if excludeLines else None
+    IGNORE_CACHE[path] = (mtime, pattern)
+    return pattern
+# ########################################################################### #
+
 # --------------------------------------------------------------------------- #
 def generateSrt(subs):
     '''Generate SRT formatted subtitles from intermediate format
 
     :param subs: Intermediate format
-    :type subs: list of dictionaries
+    :type subs: list of :class:`Cue`
 
     :returns: List with the srt subtitles and the transcript as items
     :rtype: list of string
     '''
-    #Read lines to ingore
-    excludeLines = []
-    excludeFile = os.path.join(os.path.dirname(os.path.realpath(__file__)), "subignore.txt")
-    try:
-        with open(excludeFile, 'r') as f:
-            excludeLines = [l.strip() for l in f.readlines()]
-    except IOError:
-        pass
+    #Get lines to ignore
+    ignore = loadIgnore()
     counter = 0
-    srt = ""
-    trans = ""
+    srt = []
+    trans = []
 
     #Generate srt
     for sub in subs:
-        text = ""
-        textRaw = ""
-        if not "lines" in sub or not sub["lines"]:
+        if not sub.lines:
             continue
-        ignore = False
-        for line in sub["lines"]:
-            #Check if to be ignored
-            if any(e in line["text"] for e in excludeLines):
-                ignore = True
-                break
-            #Check if color is given
-            if "color" in line:
-                text += "<font color=\"{}\">{}</font>".format(line["color"], line["text"])
-                textRaw += line["text"]
-            else:
-                text += line["text"]
-                textRaw += line["text"]
-        if not ignore:
-            counter += 1
-            srt += "{}\n{} --> {}\n{}\n\n".format(counter, sub["begin"], sub["end"], text)
-            trans += "{}\n\n".format(textRaw)
+        textRaw = [t for _, t in sub.lines]
+        #Check if to be ignored (phrases never contain line breaks, so they can't match across lines)
+        if ignore and ignore.search("\n".join(textRaw)):
+            continue
+        #Add color if given
+        text = [t if color is None else "<font color=\"{}\">{}</font>".format(color, t) for color, t in sub.lines]
+        counter += 1
+        srt.append("{}\n{} --> {}\n{}\n\n".format(counter, formatTime(sub.begin), formatTime(sub.end), "".join(text)))
+        trans.append("{}\n\n".format("".join(textRaw)))
 
-    return [srt, trans]
+    return ["".join(srt), "".join(trans)]
 # ########################################################################### #
 
 # --------------------------------------------------------------------------- #
@@ -163,41 +347,147 @@ def convertEBU(subtitles):
 
 # --------------------------------------------------------------------------- #
 def main(args):
-    '''Convert subtitle file to the SRT format
+    '''Convert subtitle files to the SRT format
 
     :param args: The command line arguments given by the user
     :type args: list
     '''
-    #Read file if one is given, else throw an error
-    try:
-        with open(args[1], 'r') as f:
-            raw = f.read()
-    except IndexError:
-        print("Usage: subconvert.py SUBFILE")
+    #Get options
+    transcript = False
+    force = False
+    edits = {}
+    workers = WORKERS or os.cpu_count() or 1
+    while len(args) > 1 and args[1].startswith('-') and args[1] != '-':
+        opt = args.pop(1)
+        if opt == '-t':
+            transcript = True
+        elif opt == '-f':
+            force = True
+        elif opt == '-s':
+            try:
+                edits["shift"] = int(args.pop(1))
+            except (IndexError, ValueError):
+                sys.exit("ERROR: -s requires a number of milliseconds")
+        elif opt == '-m':
+            edits["merge"] = True
+        elif opt == '-o':
+            edits["noOverlaps"] = True
+        elif opt == '-j':
+            try:
+                workers = max(1, int(args.pop(1)))
+            except (IndexError, ValueError):
+                sys.exit("ERROR: -j requires a number")
+        else:
+            sys.exit("ERROR: Unknown option \"{}\"".format(opt))
+    if len(args) < 2:
+        print("Usage: subconvert.py [OPTIONS] SUBFILE|DIRECTORY|GLOB|- ...")
         return
-    except IOError:
-        print("File not found '{}'".format(args[1]))
-        print("Usage: subconvert.py SUBFILE")
+
+    #Convert stdin to stdout
+    if args[1:] == ['-']:
+        raw = sys.stdin.read()
+        if raw.lstrip().startswith("WEBVTT"):
+            subs = parseVTT(raw)
+        else:
+            subs = parseEBU(raw)
+        [srt, trans] = generateSrt(editCues(subs, **edits))
+        sys.stdout.write(trans if transcript else srt)
+        return
+
+    files = findFiles(args[1:])
+    if not files:
+        print("No subtitle files found, currently EBU-TT-D (.xml) and WEBVTT (.vtt) are supported")
         return
-    subFileComp = os.path.splitext(args[1])
+    converted = 0
+    failed = 0
+    start = time.monotonic()
+    if workers > 1 and len(files) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(convertFile, f, transcript, force, edits) for f in files]
+            for f, future in zip(files, futures):
+                try:
+                    converted += future.result()
+                except (OSError, ValueError, KeyError, etree.LxmlError) as e:
+                    print("ERROR: Unable to convert \"{}\" ({})".format(f, e))
+                    failed += 1
+    else:
+        for f in files:
+            try:
+                converted += convertFile(f, transcript, force, edits)
+            except (OSError, ValueError, KeyError, etree.LxmlError) as e:
+                print("ERROR: Unable to convert \"{}\" ({})".format(f, e))
+                failed += 1
+    #Print summary
+    elapsed = max(time.monotonic() - start, 1e-6)
+    skipped = len(files) - converted - failed
+    print("Converted {} files in {:.1f} s ({:.1f} files/s), {} up to date, {} failed".format(converted, elapsed, converted / elapsed, skipped, failed))
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def findFiles(paths):
+    '''Get the subtitle files given as files, directories or glob patterns
+
+    :param paths: Paths of files or directories or glob patterns
+    :type paths: list of strings
 
+    :returns: Paths of the subtitle files (.xml and .vtt) without duplicates
+    :rtype: list of strings
+    '''
+    files = []
+    seen = set()
+    for path in paths:
+        if os.path.isdir(path):
+            candidates = sorted(os.path.join(path, f) for f in os.listdir(path))
+        elif any(c in path for c in "*?["):
+            candidates = sorted(glob.glob(path))
+        else:
+            candidates = [path]
+        for f in candidates:
+            if os.path.splitext(f)[1] in SUBTITLE_FORMATS and f not in seen:
+                seen.add(f)
+                files.append(f)
+    return files
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def convertFile(path, transcript=False, force=False, edits=None):
+    '''Convert a subtitle file to a .srt file next to it unless it is up to date
+
+    :param path: Path of the subtitle file in the EBU-TT-D (.xml) or the WEBVTT (.vtt) format
+    :type path: string
+    :param transcript: Whether to also write the transcript to a .txt file
+    :type transcript: boolean
+    :param force: Whether to convert the file even if the output is newer
+    :type force: boolean
+    :param edits: Keyword arguments for :func:`editCues`
+    :type edits: dictionary
+
+    :returns: True if converted, False if the output was up to date
+    :rtype: boolean
+    '''
+    subFileComp = os.path.splitext(path)
+    outputs = [subFileComp[0] + ".srt"]
+    if transcript:
+        outputs.append(subFileComp[0] + ".txt")
+    #Skip if all outputs are newer than the subtitles
+    if not force:
+        mtime = os.path.getmtime(path)
+        if all(os.path.isfile(o) and os.path.getmtime(o) >= mtime for o in outputs):
+            return False
+    with open(path, 'r', encoding='utf8') as f:
+        raw = f.read()
     #Check file format
     if subFileComp[1] == ".xml":
         #Parse EBU-TT-D
         subs = parseEBU(raw)
-    elif subFileComp[1] == ".vtt":
+    else:
         #Parse WEBVTT
         subs = parseVTT(raw)
-    else:
-        #Unknown file, throw error
-        print("Unknown file, currently EBU-TT-D (.xml) and WEBVTT (.vtt) are supported")
-
-    #Generate srt
-    [srt, _] = generateSrt(subs)
-    #Save .srt file
-    srtFile = subFileComp[0] + ".srt"
-    with open(srtFile, 'w', encoding='utf8') as f:
-        f.write(srt)
+    #Generate srt and save files
+    for output, content in zip(outputs, generateSrt(editCues(subs, **(edits or {})))):
+        with open(output, 'w', encoding='utf8') as f:
+            f.write(content)
+    return True
 # ########################################################################### #
 
 # --------------------------------------------------------------------------- #
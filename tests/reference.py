@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+''' reference - Previous subtitle conversion and synthetic tagesschau subtitles for the tests and benchmarks '''
+
+import sys
+import os
+import random
+import warnings
+from bs4 import BeautifulSoup
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import subconvert
+
+#Directory with the subtitle fixtures
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+#Words and phrases of the synthetic subtitles
+WORDS = ("die Bundesregierung hat heute beschlossen dass der Haushalt für das kommende Jahr deutlich steigen soll "
+         "Opposition kritisiert Pläne als unzureichend Wetter morgen Regen Sonne Wind im Norden Süden").split()
+PHRASES = ["Studio: Max Mustermann", "Untertitel: NDR", "&amp; &lt;Zitat&gt;", "&#8222;Wir lehnen das ab&#8220;"]
+#Styles of the synthetic subtitles
+STYLES = {"textWhite" : "#ffffff", "textYellow" : "#ffff00", "textCyan" : "#00ffff"}
+HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<tt:tt xmlns:tt="http://www.w3.org/ns/ttml" xmlns:tts="http://www.w3.org/ns/ttml#styling" xmlns:ttp="http://www.w3.org/ns/ttml#parameter" ttp:timeBase="media" xml:lang="de">
+<tt:head>
+<tt:styling>
+<tt:style xml:id="defaultStyle" tts:fontFamily="Verdana,Arial,Tiresias" tts:fontSize="160%"/>
+{}
+</tt:styling>
+<tt:layout><tt:region xml:id="bottom" tts:origin="10% 10%" tts:extent="80% 80%" tts:displayAlign="after"/></tt:layout>
+</tt:head>
+<tt:body>
+<tt:div style="defaultStyle">
+'''
+FOOTER = '''</tt:div>
+</tt:body>
+</tt:tt>
+'''
+
+# --------------------------------------------------------------------------- #
+def generateEBU(cues, seed=0):
+    '''Generate tagesschau style EBU-TT subtitles
+
+    The cues have one or two colored lines, some contain entities or one of the PHRASES.
+
+    :param cues: Number of cues
+    :type cues: integer
+    :param seed: Seed of the random generator
+    :type seed: integer
+
+    :returns: Subtitles in the EBU-TT format
+    :rtype: string
+    '''
+    rand = random.Random(seed)
+    styles = "\n".join('<tt:style xml:id="{}" tts:color="{}" tts:backgroundColor="#000000c2"/>'.format(s, c) for s, c in STYLES.items())
+    out = [HEADER.format(styles)]
+    ms = 10 * 3600000
+    for i in range(cues):
+        begin = ms
+        end = begin + rand.randint(1000, 4000)
+        ms = end + rand.randint(0, 500)
+        spans = []
+        for _ in range(rand.choice([1, 2, 2])):
+            if rand.random() < 0.05:
+                text = rand.choice(PHRASES)
+            else:
+                text = " ".join(rand.choice(WORDS) for _ in range(rand.randint(2, 7)))
+            spans.append('<tt:span style="{}">{}</tt:span>'.format(rand.choice(list(STYLES)), text))
+        out.append('<tt:p xml:id="subtitle{}" region="bottom" begin="{}" end="{}">\n{}\n</tt:p>\n'.format(
+            i + 1, subconvert.formatTime(begin).replace(',', '.'), subconvert.formatTime(end).replace(',', '.'), "\n<tt:br/>\n".join(spans)))
+    out.append(FOOTER)
+    return "".join(out)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def parseEBUSoup(subtitles):
+    '''Parse EBU-TT subtitles with BeautifulSoup like subconvert did before it used lxml
+
+    The end time is parsed like the begin time (the old parser used the begin time instead).
+
+    :param subtitles: Subtitles in the EBU-TT format
+    :type subtitles: string
+
+    :returns: Intermediate format
+    :rtype: list of :class:`subconvert.Cue`
+    '''
+    colors = {}
+    subs = []
+    with warnings.catch_warnings():
+        #Parsed as HTML like before
+        warnings.simplefilter("ignore")
+        ebutt = BeautifulSoup(subtitles, "html.parser")
+    #Get colors
+    for style in ebutt.find("tt:styling").find_all("tt:style"):
+        if "tts:color" in style.attrs:
+            colors[style.attrs["xml:id"]] = style.attrs["tts:color"]
+    #Loop through
+    for p in ebutt.find("tt:div").find_all("tt:p"):
+        lines = []
+        for item in p.find_all():
+            #span element: text
+            if "span" in item.name:
+                lines.append((colors[item.attrs["style"]], item.text))
+            #br: insert line break
+            elif "br" in item.name:
+                lines.append(subconvert.BREAK)
+        if lines:
+            subs.append(subconvert.Cue(subconvert.parseTime(p.attrs["begin"], True), subconvert.parseTime(p.attrs["end"], True), tuple(lines)))
+
+    return subs
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def generateSrtConcat(subs, ignorePath):
+    '''Generate SRT subtitles like subconvert did before it cached the ignore list
+
+    The ignore file is read on every call and the output is built by string concatenation.
+
+    :param subs: Intermediate format
+    :type subs: list of :class:`subconvert.Cue`
+    :param ignorePath: Path of the file with one phrase to ignore per line
+    :type ignorePath: string
+
+    :returns: List with the srt subtitles and the transcript as items
+    :rtype: list of string
+    '''
+    #Read lines to ignore
+    excludeLines = []
+    try:
+        with open(ignorePath, 'r') as f:
+            excludeLines = [l.strip() for l in f.readlines()]
+    except IOError:
+        pass
+    counter = 0
+    srt = ""
+    trans = ""
+
+    #Generate srt
+    for sub in subs:
+        text = ""
+        textRaw = ""
+        if not sub.lines:
+            continue
+        ignore = False
+        for color, line in sub.lines:
+            #Check if to be ignored
+            if any(e in line for e in excludeLines):
+                ignore = True
+                break
+            #Check if color is given
+            if color is not None:
+                text += "<font color=\"{}\">{}</font>".format(color, line)
+            else:
+                text += line
+            textRaw += line
+        if not ignore:
+            counter += 1
+            srt += "{}\n{} --> {}\n{}\n\n".format(counter, subconvert.formatTime(sub.begin), subconvert.formatTime(sub.end), text)
+            trans += "{}\n\n".format(textRaw)
+
+    return [srt, trans]
+# ########################################################################### #
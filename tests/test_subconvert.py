@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+''' Tests of the subtitle conversion '''
+
+import sys
+import os
+import tempfile
+import unittest
+from unittest import mock
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import subconvert
+import reference
+
+# --------------------------------------------------------------------------- #
+class TestParseTime(unittest.TestCase):
+    '''Time codes of the EBU-TT and WEBVTT subtitles'''
+
+    def testEbuOffset(self):
+        self.assertEqual(subconvert.parseTime("10:00:05.120", True), 5120)
+        self.assertEqual(subconvert.parseTime("10:14:59.999", True), 899999)
+        self.assertEqual(subconvert.parseTime("11:02:03.000", True), 3723000)
+
+    def testEbuBelowTen(self):
+        self.assertEqual(subconvert.parseTime("00:00:05.120", True), 5120)
+        self.assertEqual(subconvert.parseTime("01:02:03.000", True), 3723000)
+
+    def testEbuMinutes(self):
+        self.assertEqual(subconvert.parseTime("15:30.000", True), 930000)
+
+    def testVttMinutes(self):
+        self.assertEqual(subconvert.parseTime("15:30.000"), 930000)
+        self.assertEqual(subconvert.parseTime("00:01.500"), 1500)
+
+    def testVttHours(self):
+        self.assertEqual(subconvert.parseTime("1:02:03.000"), 3723000)
+        self.assertEqual(subconvert.parseTime("10:00:05.120"), 36005120)
+
+    def testSrtComma(self):
+        self.assertEqual(subconvert.parseTime("00:00:05,120"), 5120)
+
+    def testInvalid(self):
+        for timecode in ["5.120", "1:2:3:4.000", "aa:bb.000"]:
+            with self.assertRaises(ValueError):
+                subconvert.parseTime(timecode)
+
+    def testVttCues(self):
+        vtt = "WEBVTT\n\nSub1\n15:30.000 --> 15:32.500\nErste Zeile\n\nSub2\n1:02:03.000 --> 1:02:04.000 line:90%\nZweite Zeile\n"
+        subs = subconvert.parseVTT(vtt)
+        self.assertEqual([(c.begin, c.end) for c in subs], [(930000, 932500), (3723000, 3724000)])
+        self.assertEqual(subconvert.formatTime(subs[1].begin), "01:02:03,000")
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+class TestParseEBU(unittest.TestCase):
+    '''EBU-TT parsing and conversion to SRT'''
+
+    def setUp(self):
+        #Don't apply a local ignore list
+        patcher = mock.patch.object(subconvert, "loadIgnore", return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def readFixture(self, name):
+        with open(os.path.join(reference.DATA, name), 'r', encoding='utf8') as f:
+            return f.read()
+
+    def testFixture(self):
+        srt, transcript = subconvert.convertEBU(self.readFixture("tagesschau.xml"))
+        self.assertEqual(srt, self.readFixture("tagesschau.srt"))
+        self.assertEqual(transcript, self.readFixture("tagesschau.txt"))
+
+    def testSpansAndEntities(self):
+        subs = subconvert.parseEBU(self.readFixture("tagesschau.xml"))
+        self.assertEqual(len(subs), 8)
+        self.assertEqual(subs[4].lines, (("#ffff00", "\u201eDas ist ein guter Tag"), subconvert.BREAK, ("#ffff00", "f\u00fcr Deutschland\u201c, sagte der Minister.")))
+        self.assertEqual(subs[6].lines, (("#ffff00", "Wir lehnen das ab."), subconvert.BREAK, ("#ffffff", "Die Abstimmung fiel mit 399 zu 280 Stimmen aus.")))
+        self.assertEqual(subs[7].lines, (("#ffffff", "Die Wetteraussichten: Morgen 12 bis 18 Grad <> regional Regen."),))
+        self.assertEqual((subs[7].begin, subs[7].end), (892080, 899960))
+
+    def testSoupEquivalence(self):
+        for seed in range(3):
+            raw = reference.generateEBU(500, seed)
+            expected = [(c.begin, c.end, c.lines) for c in reference.parseEBUSoup(raw)]
+            self.assertEqual([(c.begin, c.end, c.lines) for c in subconvert.parseEBU(raw)], expected)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+class TestGenerateSrt(unittest.TestCase):
+    '''SRT output and ignore list compared with the previous implementation'''
+
+    IGNORE_LISTS = {"empty" : "",
+                    "phrases" : "Studio: Max Mustermann\nUntertitel: NDR\n",
+                    "metacharacters" : "(Zitat)\n<Zitat>\n[a-z]+\nH.ushalt\n",
+                    "blank line" : "Wetter\n\nRegen\n",
+                    "many phrases" : "".join("Phrase {}\n".format(i) for i in range(200)) + "Sonne Wind\n"}
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.ignorePath = os.path.join(directory.name, "subignore.txt")
+        loadIgnore = subconvert.loadIgnore
+        patcher = mock.patch.object(subconvert, "loadIgnore", lambda: loadIgnore(self.ignorePath))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        with open(os.path.join(reference.DATA, "tagesschau.xml"), 'r', encoding='utf8') as f:
+            fixture = f.read()
+        vtt = "WEBVTT\n\nSub1\n00:01.000 --> 00:02.000\nUntertitel: NDR\n\nSub2\n00:03.000 --> 00:04.500\nZweite\nZeile (Zitat)\n"
+        self.subtitles = [subconvert.parseEBU(fixture), subconvert.parseVTT(vtt)]
+        self.subtitles += [subconvert.parseEBU(reference.generateEBU(1000, seed)) for seed in range(3)]
+
+    def writeIgnore(self, content, mtime):
+        with open(self.ignorePath, 'w') as f:
+            f.write(content)
+        #Distinct modification times, the cached pattern is only replaced if it changes
+        os.utime(self.ignorePath, (mtime, mtime))
+
+    def assertSameOutput(self):
+        for subs in self.subtitles:
+            self.assertEqual(subconvert.generateSrt(subs), reference.generateSrtConcat(subs, self.ignorePath))
+
+    def testNoIgnoreFile(self):
+        self.assertSameOutput()
+
+    def testIgnoreLists(self):
+        for mtime, (name, content) in enumerate(self.IGNORE_LISTS.items(), 1000):
+            with self.subTest(name):
+                self.writeIgnore(content, mtime)
+                self.assertSameOutput()
+
+    def testBlankLineIgnoresAll(self):
+        self.writeIgnore("Wetter\n\n", 1000)
+        self.assertEqual(subconvert.generateSrt(self.subtitles[0]), ["", ""])
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+if __name__ == "__main__":
+    unittest.main()
+# ########################################################################### #
@@ -3,9 +3,28 @@
 
 import sys
 import os
+import time
 import sqlite3
-import subprocess
-import hashlib
+from collections import deque, Counter
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import tsarchiver
+
+#Number of bytes to read at once when calculating checksums
+HASH_BUFFER = 8*1024*1024
+#Number of files verified in parallel (None: number of CPUs)
+WORKERS = None
+#Maximum number of files read in parallel from the same disk (None: unlimited)
+PER_DISK = None
+#Number of files per worker to look ahead for files on idle disks
+LOOKAHEAD = 4
+#Minimum file size in bytes for splitting the verification of a file across workers
+SPLIT_MIN = 256*1024*1024
+#Number of checksum updates to write to the database at once
+UPDATE_BATCH = 100
+#Days after which unchanged files are verified again in incremental mode
+MAX_AGE = 30
+#Days in which a scrub should cover the whole archive
+SCRUB_PERIOD = 30
 
 # --------------------------------------------------------------------------- #
 def check(argv):
@@ -14,16 +33,59 @@ def check(argv):
     :param argv: The command line arguments given by the user
     :type argv: list
     '''
+    #Get options
+    checkLevel = None
+    workers = WORKERS or os.cpu_count() or 1
+    perDisk = PER_DISK
+    incremental = False
+    maxAge = MAX_AGE
+    scrub = False
+    scrubPeriod = SCRUB_PERIOD
+    maxBytes = None
+    maxTime = None
+    while len(argv) > 1 and argv[1].startswith('-'):
+        opt = argv.pop(1)
+        if opt == '-c':
+            checkLevel = "full"
+        elif opt == '-l':
+            checkLevel = argv.pop(1) if len(argv) > 1 else None
+            if checkLevel not in tsarchiver.CHECK_LEVELS:
+                sys.exit("ERROR: -l requires one of {}".format(", ".join(tsarchiver.CHECK_LEVELS)))
+        elif opt == '-i':
+            incremental = True
+        elif opt == '-a':
+            try:
+                maxAge = float(argv.pop(1))
+            except (IndexError, ValueError):
+                sys.exit("ERROR: -a requires a number")
+        elif opt == '-s':
+            scrub = True
+        elif opt in ['-p', '-b', '-t']:
+            try:
+                n = float(argv.pop(1))
+            except (IndexError, ValueError):
+                sys.exit("ERROR: {} requires a number".format(opt))
+            if opt == '-p':
+                scrubPeriod = n
+            elif opt == '-b':
+                maxBytes = int(n * 1e9)
+            else:
+                maxTime = n * 60
+        elif opt in ['-j', '-d']:
+            try:
+                n = max(1, int(argv.pop(1)))
+            except (IndexError, ValueError):
+                sys.exit("ERROR: {} requires a number".format(opt))
+            if opt == '-j':
+                workers = n
+            else:
+                perDisk = n
+        else:
+            sys.exit("ERROR: Unknown option \"{}\"".format(opt))
     #Get directory
     try:
-        if argv[1] == '-c':
-            checkFile = True
-            argv.pop(1)
-        else:
-            checkFile = False
         directory = os.path.normpath(os.path.abspath(argv[1]))
     except IndexError:
-        checkFile = False
         directory = os.getcwd()
 
     dbPath = os.path.join(directory, "archive.db")
@@ -33,43 +95,398 @@ def check(argv):
     try:
         #Connect to database
         db = connectDB(dbPath)
-        r = db.execute("SELECT id,name,checksum FROM videos;")
-        for item in r.fetchall():
-            filePath = os.path.join(directory, item[1])
+        #Migrations can rebuild tables, back up the database first
+        if tsarchiver.needsUpdate(db):
+            print("Backing up database before updating it")
+            if not tsarchiver.backupDB(db, directory):
+                sys.exit("ERROR: Database backup failed")
+        tsarchiver.updateDB(db.cursor())
+        #Read the videos through their own connection: an open statement on the writing connection
+        #would keep its snapshot, so writing after the archiver committed fails with "database is locked"
+        reader = connectDB(dbPath)
+        #Rows: id, name, checksum, ledger size, mtime, inode, verified and level, chunk size and digests
+        cmd = "SELECT videos.id, videos.name, videos.checksum, ledger.size, ledger.mtime, ledger.inode, ledger.verified, ledger.level, chunks.chunkSize, chunks.hashes FROM videos LEFT JOIN ledger ON ledger.videoID = videos.id LEFT JOIN chunks ON chunks.videoID = videos.id"
+        if scrub:
+            #Least recently verified first
+            if maxBytes is None and maxTime is None:
+                maxBytes = getScrubBudget(db, directory, scrubPeriod)
+            videos = reader.execute(cmd + " ORDER BY ledger.verified IS NOT NULL, ledger.verified, videos.id;")
+            videos = limitBudget(directory, videos, maxBytes)
+        else:
+            videos = reader.execute(cmd + ";")
+        if incremental:
+            skipped = [0]
+            videos = selectChanged(directory, videos, checkLevel, maxAge, skipped)
+        updates = []
+        ledger = []
+        chunkUpdates = []
+        checks = []
+        totalFiles = 0
+        totalBytes = 0
+        start = time.monotonic()
+        deadline = start + maxTime if scrub and maxTime is not None else None
+        for item, result in verifyFiles(directory, videos, checkLevel, workers, perDisk, deadline):
             #Check if file exists
-            if not os.path.isfile(filePath):
+            if result is None:
                 print("ERROR: File {} not found".format(item[1]))
                 continue
+            checksum, chunks, passed, signature = result
+            stored = splitDigests(item[9])
+            totalFiles += 1
+            totalBytes += signature[0]
             #Check file integrity
-            if checkFile:
-                cmd = ["ffmpeg", "-v", "error", "-i", filePath, "-f", "null", "-"]
-                out, _ = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()
-                if out:
-                    print("ERROR: File \"{}\" corrupt!".format(item[1]))
+            if checkLevel:
+                if passed:
+                    print("File \"{}\" {} check passed".format(item[1], checkLevel))
                 else:
-                    print("File \"{}\" check passed".format(item[1]))
-            #Calculate checksum
-            sha256 = hashlib.sha256()
-            with open(filePath, "rb") as vf:
-                for chunk in iter(lambda: vf.read(4096), b""):
-                    sha256.update(chunk)
-            checksum = sha256.hexdigest()
+                    print("ERROR: File \"{}\" corrupt!".format(item[1]))
+                checks.append((item[0], checkLevel, int(passed), int(time.time())))
             if item[2]:
-                #Compare checksums
-                if checksum == item[2]:
+                #Compare checksums (or only the chunk digests for files verified in chunk ranges)
+                verified = checksum == item[2] if checksum else chunks == stored
+                if verified:
                     print("File \"{}\" checksums match".format(item[1]))
                 else:
                     print("ERROR: File \"{}\" checksums mismatch".format(item[1]))
+                    #Localize corruption
+                    if stored:
+                        for first, last in corruptRanges(stored, chunks, item[8]):
+                            print("ERROR: File \"{}\" corrupt bytes {}-{}".format(item[1], first, last))
             else:
                 print("File \"{}\" no checksum saved yet".format(item[1]))
-                db.execute("UPDATE videos SET checksum = ? WHERE id = ?;", (checksum, item[0]))
+                updates.append((checksum, item[0]))
+                verified = True
+            #Record successful verification
+            if verified and passed is not False:
+                ledger.append((item[0],) + signature + (int(time.time()), checkLevel))
+            #Save missing chunk digests
+            if verified and not stored:
+                chunkUpdates.append((item[0], chunks))
+            if len(updates) + len(ledger) + len(chunkUpdates) + len(checks) >= UPDATE_BATCH:
+                saveBatch(db, updates, ledger, chunkUpdates, checks)
+        saveBatch(db, updates, ledger, chunkUpdates, checks)
+        #Record scrub progress
+        if scrub:
+            db.execute("INSERT INTO scrubs(timestamp, files, bytes) VALUES(?,?,?);", (int(time.time()), totalFiles, totalBytes))
+        #Print throughput
+        elapsed = max(time.monotonic() - start, 1e-6)
+        if incremental:
+            print("Skipped {} unchanged files".format(skipped[0]))
+        print("Verified {:.1f} MB in {:.1f} s ({:.1f} MB/s)".format(totalBytes / 1e6, elapsed, totalBytes / 1e6 / elapsed))
         #Close database
+        reader.close()
         closeDB(db)
     except sqlite3.Error as e:
-        print("ERROR: " + e)
+        print("ERROR: {}".format(e))
         return
 # ########################################################################### #
 
+# --------------------------------------------------------------------------- #
+def verifyFiles(directory, videos, checkLevel, workers, perDisk=None, deadline=None):
+    '''Verify video files in parallel worker processes
+
+    Files are submitted in order, but files on idle disks may be started
+    ahead of files on busy ones. Large files with stored chunk digests are
+    split into ranges of chunks verified in parallel. The results are
+    returned in the order of the videos. After the deadline no new files
+    are started, files already started are finished.
+
+    :param directory: Path of the archive directory
+    :type directory: string
+    :param videos: The video rows to verify, see :func:`check`
+    :type videos: iterable of tuples
+    :param checkLevel: Integrity check to perform on each file (quick, sample, full or None)
+    :type checkLevel: string
+    :param workers: Number of files to verify in parallel
+    :type workers: integer
+    :param perDisk: Maximum number of files to read in parallel from the same disk (None: unlimited)
+    :type perDisk: integer
+    :param deadline: Time (see :func:`time.monotonic`) after which no new files are started (None: unlimited)
+    :type deadline: float
+
+    :returns: The video rows with the SHA-256 checksum (None if only the chunks were verified), the chunk digests, whether the integrity check passed (None if not checked) and the file signature, or None if the file doesn't exist
+    :rtype: generator of tuples
+    '''
+    videos = iter(videos)
+    #Entries: [row, disk, signature, jobs, futures, split]
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while True:
+            #Time budget used up: drop the files which haven't been started
+            if deadline is not None and time.monotonic() >= deadline:
+                videos = iter(())
+                pending = deque(e for e in pending if e[4])
+            #Fill lookahead window
+            while len(pending) < workers * LOOKAHEAD:
+                item = next(videos, None)
+                if item is None:
+                    break
+                filePath = os.path.join(directory, item[1])
+                try:
+                    disk = os.stat(filePath).st_dev if os.path.isfile(filePath) else None
+                    signature = getSignature(filePath)
+                except OSError:
+                    disk = None
+                    signature = None
+                jobs, split = planJobs(item, filePath, signature, checkLevel, workers) if disk is not None else ([], False)
+                pending.append([item, disk, signature, jobs, [], split])
+            if not pending:
+                return
+            #Start jobs on disks with free capacity
+            busy = Counter(e[1] for e in pending for f in e[4] if not f.done())
+            running = sum(busy.values())
+            for e in pending:
+                if not e[4] and deadline is not None and time.monotonic() >= deadline:
+                    continue
+                while e[3] and running < workers and (not perDisk or busy[e[1]] < perDisk):
+                    func, args = e[3].pop(0)
+                    e[4].append(pool.submit(func, *args))
+                    busy[e[1]] += 1
+                    running += 1
+            #Return next result in order
+            head = pending[0]
+            if head[1] is None:
+                pending.popleft()
+                yield head[0], None
+            elif not head[3] and all(f.done() for f in head[4]):
+                pending.popleft()
+                results = [f.result() for f in head[4]]
+                if head[5]:
+                    chunks = [c for r in (results[:-1] if checkLevel else results) for c in r]
+                    yield head[0], (None, chunks, results[-1] if checkLevel else None, head[2])
+                else:
+                    yield head[0], results[0] + (head[2],)
+            else:
+                wait([f for e in pending for f in e[4] if not f.done()], return_when=FIRST_COMPLETED)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def planJobs(item, path, signature, checkLevel, workers):
+    '''Plan the worker jobs to verify a file
+
+    :param item: The video row, see :func:`check`
+    :type item: tuple
+    :param path: Path of the video file
+    :type path: string
+    :param signature: The file signature, see :func:`getSignature`
+    :type signature: tuple
+    :param checkLevel: Integrity check to perform (quick, sample, full or None)
+    :type checkLevel: string
+    :param workers: Number of worker processes
+    :type workers: integer
+
+    :returns: List of (function, arguments) jobs and whether the file is verified in chunk ranges
+    :rtype: list of tuples, boolean
+    '''
+    chunkSize = item[8] or tsarchiver.CHUNK_SIZE
+    #Verify large files with known chunk digests in parallel chunk ranges
+    if item[2] and item[9] and workers > 1 and signature[0] >= SPLIT_MIN:
+        count = -(-signature[0] // chunkSize)
+        perJob = -(-count // min(workers, count))
+        jobs = [(tsarchiver.hashChunks, (path, first, perJob, chunkSize, HASH_BUFFER)) for first in range(0, count, perJob)]
+        if checkLevel:
+            jobs.append((tsarchiver.checkVideo, (path, checkLevel)))
+        return jobs, True
+    return [(verifyFile, (path, checkLevel, chunkSize))], False
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def verifyFile(path, checkLevel=None, chunkSize=tsarchiver.CHUNK_SIZE):
+    '''Calculate the checksum and chunk digests of a file and optionally check its integrity
+
+    :param path: Path of the video file
+    :type path: string
+    :param checkLevel: Integrity check to perform (quick, sample, full or None)
+    :type checkLevel: string
+    :param chunkSize: Size of the chunks in bytes
+    :type chunkSize: integer
+
+    :returns: The SHA-256 checksum, the chunk digests and whether the integrity check passed (None if not checked)
+    :rtype: tuple
+    '''
+    passed = tsarchiver.checkVideo(path, checkLevel) if checkLevel else None
+    checksum, chunks = tsarchiver.hashFile(path, HASH_BUFFER, chunkSize)
+    return checksum, chunks, passed
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def corruptRanges(expected, actual, chunkSize):
+    '''Get the byte ranges in which the chunk digests of a file differ from the stored ones
+
+    :param expected: The stored chunk digests
+    :type expected: list of bytes
+    :param actual: The chunk digests of the file
+    :type actual: list of bytes
+    :param chunkSize: Size of the chunks in bytes
+    :type chunkSize: integer
+
+    :returns: List of (first byte, last byte) ranges
+    :rtype: list of tuples
+    '''
+    ranges = []
+    for i in range(max(len(expected), len(actual))):
+        if i < len(expected) and i < len(actual) and expected[i] == actual[i]:
+            continue
+        if ranges and ranges[-1][1] == i * chunkSize - 1:
+            ranges[-1] = (ranges[-1][0], (i+1) * chunkSize - 1)
+        else:
+            ranges.append((i * chunkSize, (i+1) * chunkSize - 1))
+    return ranges
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def getScrubBudget(db, directory, period):
+    '''Calculate the number of bytes to scrub so the archive is covered once per period
+
+    The budget is the share of the archive size corresponding to the time
+    since the last scrub (one day if there was none).
+
+    :param db: Connection to the database
+    :type db: sqlite3.Connection
+    :param directory: Path of the archive directory
+    :type directory: string
+    :param period: Days in which the whole archive should be scrubbed
+    :type period: float
+
+    :returns: Number of bytes to scrub
+    :rtype: integer
+    '''
+    total = 0
+    for (name,) in db.execute("SELECT name FROM videos;"):
+        try:
+            total += os.path.getsize(os.path.join(directory, name))
+        except OSError:
+            pass
+    r = db.execute("SELECT MAX(timestamp) FROM scrubs;").fetchone()
+    elapsed = time.time() - r[0] if r[0] else 86400
+    return int(total * min(1, elapsed / (period * 86400)))
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def limitBudget(directory, videos, maxBytes):
+    '''Pass on videos until a byte budget is used up
+
+    The time budget is enforced when the files are started, see :func:`verifyFiles`.
+
+    :param directory: Path of the archive directory
+    :type directory: string
+    :param videos: The video rows
+    :type videos: iterable of tuples
+    :param maxBytes: Maximum number of bytes to verify (None: unlimited)
+    :type maxBytes: integer
+
+    :returns: The videos within the budget
+    :rtype: generator of tuples
+    '''
+    passed = 0
+    for item in videos:
+        if maxBytes is not None and passed >= maxBytes:
+            return
+        try:
+            passed += os.path.getsize(os.path.join(directory, item[1]))
+        except OSError:
+            pass
+        yield item
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def selectChanged(directory, videos, checkLevel, maxAge, skipped):
+    '''Filter out videos which are unchanged since their last successful verification
+
+    A video is verified again if its size, mtime or inode changed, if the
+    last verification is older than maxAge days or if it was verified with
+    a lower check level than requested.
+
+    :param directory: Path of the archive directory
+    :type directory: string
+    :param videos: The video rows, see :func:`check`
+    :type videos: iterable of tuples
+    :param checkLevel: Requested integrity check level (quick, sample, full or None)
+    :type checkLevel: string
+    :param maxAge: Days after which a video is verified again
+    :type maxAge: float
+    :param skipped: One element list in which to count the skipped videos
+    :type skipped: list
+
+    :returns: The videos to verify
+    :rtype: generator of tuples
+    '''
+    oldest = time.time() - maxAge * 86400
+    levels = (None,) + tsarchiver.CHECK_LEVELS
+    for item in videos:
+        if item[6] is not None and item[6] >= oldest and levels.index(item[7]) >= levels.index(checkLevel):
+            try:
+                if getSignature(os.path.join(directory, item[1])) == tuple(item[3:6]):
+                    skipped[0] += 1
+                    continue
+            except OSError:
+                pass
+        yield item
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def splitDigests(hashes):
+    '''Split the stored concatenated chunk digests
+
+    :param hashes: The concatenated SHA-256 digests (or None)
+    :type hashes: bytes
+
+    :returns: The chunk digests (empty if none are stored)
+    :rtype: list of bytes
+    '''
+    if not hashes:
+        return []
+    return [hashes[i:i+32] for i in range(0, len(hashes), 32)]
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def getSignature(path):
+    '''Get the stat signature of a file
+
+    :param path: Path of the file
+    :type path: string
+
+    :raises: :class:``OSError: Unable to stat file
+
+    :returns: Size, mtime in nanoseconds and inode of the file
+    :rtype: tuple of integers
+    '''
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns, st.st_ino
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def saveBatch(db, updates, ledger, chunks, checks):
+    '''Write a batch of checksums, ledger entries, chunk digests and check results to the database
+
+    :param db: Connection to the database
+    :type db: sqlite3.Connection
+    :param updates: List of (checksum, video id) tuples, emptied afterwards
+    :type updates: list of tuples
+    :param ledger: List of (video id, size, mtime, inode, verified, level) tuples, emptied afterwards
+    :type ledger: list of tuples
+    :param chunks: List of (video id, chunk digests) tuples, emptied afterwards
+    :type chunks: list of tuples
+    :param checks: List of (video id, level, passed, timestamp) tuples, emptied afterwards
+    :type checks: list of tuples
+
+    :raises: :class:``sqlite3.Error: Unable to update database
+    '''
+    if updates:
+        db.executemany("UPDATE videos SET checksum = ? WHERE id = ?;", updates)
+    if ledger:
+        db.executemany("INSERT OR REPLACE INTO ledger(videoID, size, mtime, inode, verified, level) VALUES(?,?,?,?,?,?);", ledger)
+    for videoID, digests in chunks:
+        tsarchiver.saveChunks(db, videoID, digests)
+    if checks:
+        db.executemany("INSERT OR REPLACE INTO checks(videoID, level, passed, timestamp) VALUES(?,?,?,?);", checks)
+    db.commit()
+    updates.clear()
+    ledger.clear()
+    chunks.clear()
+    checks.clear()
+# ########################################################################### #
+
 # --------------------------------------------------------------------------- #
 def connectDB(path):
     '''Connect to a database
@@ -82,8 +499,10 @@ def connectDB(path):
     :returns: Connection to the database
     :rtype: sqlite3.Connection
     '''
-    #Connect database
-    dbCon = sqlite3.connect(path)
+    #Connect database, wait for the archiver to finish writing if necessary
+    dbCon = sqlite3.connect(path, timeout=tsarchiver.DB_TIMEOUT)
+    dbCon.execute("PRAGMA journal_mode=WAL;")
+    dbCon.execute("PRAGMA synchronous=NORMAL;")
     #Return database connection
     return dbCon
 # ########################################################################### #
@@ -6,17 +6,87 @@ import sys
 import json
 import time
 import re
-from zipfile import ZipFile, ZIP_DEFLATED
-from datetime import datetime
+from zipfile import ZipFile, ZIP_DEFLATED, BadZipFile
+from datetime import datetime, timedelta
 import subprocess
+import threading
+import queue
 import shutil
 import sqlite3
 import hashlib
+import random
+import statistics
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import pytz
 from bs4 import BeautifulSoup
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import subconvert
 
+#Page prefix and minimum probe window for each show
+SHOWS = {"ts20" : ("ts", 80), "tt" : ("tt", 20), "nm" : ("nm", 8)}
+#Number of pages to probe in parallel
+PROBE_WORKERS = 8
+#Connect and read timeout for HTTP requests in seconds
+HTTP_TIMEOUT = (10, 60)
+#Number of retries and backoff factor for failed HTTP requests
+HTTP_RETRIES = 5
+HTTP_BACKOFF = 0.5
+#Seconds for which probed pages without an episode are not requested again
+DEAD_TTL = {404 : 3600, 301 : 7*86400, "skip" : 30*86400}
+#Number of archived episodes per show from which to learn the page ID increments
+HISTORY_SIZE = 120
+#Seconds after the air time after which an episode is expected to be online
+PUBLISH_DELAY = 3600
+#Chunk size for video downloads in bytes and number of times to resume a download
+DOWNLOAD_CHUNK = 1024*1024
+DOWNLOAD_RETRIES = 5
+#Number of parallel connections per video download, minimum segment size in
+#bytes and bandwidth limit per connection in bytes/s (None: unlimited)
+DOWNLOAD_SEGMENTS = 1
+SEGMENT_MIN = 8*1024*1024
+SEGMENT_RATE = None
+#Number of bytes to read at once when calculating checksums
+HASH_BUFFER = 1024*1024
+#Seconds to wait for a database lock held by another process
+DB_TIMEOUT = 30
+#Number of most recent, daily and weekly database backups to keep
+BACKUP_KEEP = (5, 7, 8)
+#Database check on startup: "quick", "full", "auto" (full if the last full check is older than
+#INTEGRITY_INTERVAL seconds, otherwise quick) or "background" (quick, full check while archiving)
+DB_CHECKS = ("quick", "full", "auto", "background")
+DB_CHECK = "auto"
+INTEGRITY_INTERVAL = 7*86400
+#zlib compression level of the stored raw subtitles and number of episodes with derived subtitles to cache
+SUBTITLE_COMPRESSION = 9
+SUBTITLE_CACHE = 32
+#Derived subtitles of the most recently requested episodes by subtitle ID, see getSubtitles
+SUBTITLES = OrderedDict()
+SUBTITLES_LOCK = threading.Lock()
+#Row IDs in the search index are videoID*SEARCH_CUES + SRT cue number (0: topics and note)
+SEARCH_CUES = 100000
+SRT_CUE = re.compile(r"(\d+)\n(\S+) --> (\S+)\n(.*?)\n\n(?=\d+\n\S+ --> |\Z)", re.S)
+#Size of the chunks for which separate checksums are stored
+CHUNK_SIZE = 4*1024*1024
+#Integrity check levels, number and length in seconds of the windows decoded by the sample check
+CHECK_LEVELS = ("quick", "sample", "full")
+SAMPLE_WINDOWS = 3
+SAMPLE_LENGTH = 10
+#Whether to add subtitles and tags in a single ffmpeg pass instead of ffmpeg and exiftool
+REMUX = True
+#ffmpeg (mp4 muxer) metadata keys for the exiftool tags written by writeMetadata
+FFMPEG_TAGS = {"Artist" : "artist", "Album" : "album", "Title" : "title", "TVShow" : "show",
+               "TVNetworkName" : "network", "Genre" : "genre", "HDVideo" : "hd_video",
+               "MediaType" : "media_type", "ContentCreateDate" : "date",
+               "LongDescription" : "synopsis", "Comment" : "comment"}
+#Number of worker threads for the download, post-processing and hashing stages
+PIPELINE_WORKERS = (1, 1, 1)
+#Maximum number of episodes waiting in front of each stage
+PIPELINE_QUEUE = 1
+
 # --------------------------------------------------------------------------- #
 def archive(argv):
     '''Archive tagesschau, tagesthemen and nachtmagazin
@@ -24,35 +94,96 @@ def archive(argv):
     :param argv: The command line arguments given by the user
     :type argv: list
     '''
+    #Get options
+    checkLevel = None
+    workers = PROBE_WORKERS
+    segments = DOWNLOAD_SEGMENTS
+    remux = REMUX
+    stages = PIPELINE_WORKERS
+    background = False
+    backup = None
+    dbCheck = DB_CHECK
+    fullCheck = None
+    while len(argv) > 1 and argv[1].startswith('-'):
+        opt = argv.pop(1)
+        if opt == '-c':
+            checkLevel = "full"
+        elif opt == '-l':
+            checkLevel = argv.pop(1) if len(argv) > 1 else None
+            if checkLevel not in CHECK_LEVELS:
+                sys.exit("ERROR: -l requires one of {}".format(", ".join(CHECK_LEVELS)))
+        elif opt == '-j':
+            try:
+                workers = max(1, int(argv.pop(1)))
+            except (IndexError, ValueError):
+                sys.exit("ERROR: -j requires a number")
+        elif opt == '-w':
+            try:
+                stages = tuple(max(1, int(n)) for n in argv.pop(1).split(','))
+                if len(stages) != 3:
+                    raise ValueError()
+            except (IndexError, ValueError):
+                sys.exit("ERROR: -w requires three comma separated numbers")
+        elif opt == '-x':
+            remux = False
+        elif opt == '-b':
+            background = True
+        elif opt == '-v':
+            dbCheck = argv.pop(1) if len(argv) > 1 else None
+            if dbCheck not in DB_CHECKS:
+                sys.exit("ERROR: -v requires one of {}".format(", ".join(DB_CHECKS)))
+        elif opt == '-s':
+            try:
+                segments = max(1, int(argv.pop(1)))
+            except (IndexError, ValueError):
+                sys.exit("ERROR: -s requires a number")
+        else:
+            sys.exit("ERROR: Unknown option \"{}\"".format(opt))
     #Get directory
     try:
-        if argv[1] == '-c':
-            checkFile = True
-            argv.pop(1)
-        else:
-            checkFile = False
         directory = os.path.normpath(os.path.abspath(argv[1]))
     except IndexError:
-        checkFile = False
         directory = os.getcwd()
 
     dbFile = os.path.join(directory, "archive.db")
+    begin = start = time.perf_counter()
     if os.path.isfile(dbFile):
         #Database found, connect to it
         try:
-            dbCon = connectDB(dbFile)
-            print("Verifying database")
-            if not checkDB(dbCon):
-                sys.exit("ERROR: Database integrity error")
-            print("Backing up database")
-            if not backupDB(dbCon, directory):
-                sys.exit("ERROR: Database backup failed")
-            closeDB(dbCon)
             dbCon = connectDB(dbFile)
             db = dbCon.cursor()
+            if dbCheck == "auto":
+                lastCheck = getMaintenance(db, "integrity_check")
+                full = not lastCheck or time.time() - lastCheck > INTEGRITY_INTERVAL
+            else:
+                full = dbCheck == "full"
+            print("Verifying database ({} check)".format("full" if full else "quick"))
+            if not checkDB(dbCon, full):
+                sys.exit("ERROR: Database integrity error")
+            start = printPhase("Verification", start)
+            #Only defer the backup if there is no migration to back up for
+            deferBackup = background and not needsUpdate(db)
+            if not deferBackup:
+                print("Backing up database")
+                if not backupDB(dbCon, directory):
+                    sys.exit("ERROR: Database backup failed")
+                start = printPhase("Backup", start)
+            updateDB(db)
+            if full:
+                setMaintenance(db, "integrity_check")
             last = getLast(db)
+            start = printPhase("Update", start)
         except sqlite3.Error as e:
             sys.exit("ERROR: db error \"{}\"".format(e))
+        #Back up and check the database with separate connections while archiving
+        startupPool = ThreadPoolExecutor(max_workers=2)
+        if deferBackup:
+            print("Backing up database in the background")
+            backup = startupPool.submit(backupFile, dbFile, directory)
+        if dbCheck == "background":
+            print("Verifying database in the background (full check)")
+            fullCheck = startupPool.submit(checkDBFile, dbFile)
+        startupPool.shutdown(wait=False)
     else:
         #No database found, ask to create one
         while True:
@@ -93,68 +224,398 @@ def archive(argv):
             except ValueError:
                 print("Invalid input, please enter a number")
 
+    printPhase("Startup", begin)
+
     #Get shows
-    getShows(directory, last, db, checkFile)
+    start = time.perf_counter()
+    session = createSession(max(workers, segments * stages[0]))
+    cache = loadProbeCache(directory)
+    with ExifTool() as exiftool:
+        getShows(directory, last, db, checkLevel, session, workers, cache, segments, remux, exiftool, stages)
+    saveProbeCache(directory, cache, last)
+    opened, reused = sessionStats(session)
+    print("HTTP connections: {} opened, {} reused".format(opened, reused))
+    session.close()
+    printPhase("Archiving", start)
 
+    #Wait for background backup
+    if backup:
+        try:
+            if not backup.result():
+                print("WARNING: Database backup failed")
+        except sqlite3.Error as e:
+            print("WARNING: Database backup failed \"{}\"".format(e))
+    #Wait for background check
+    if fullCheck:
+        try:
+            if fullCheck.result():
+                setMaintenance(db, "integrity_check")
+            else:
+                print("WARNING: Database integrity error")
+        except sqlite3.Error as e:
+            print("WARNING: Database check failed \"{}\"".format(e))
     #Close db
     closeDB(dbCon)
 # ########################################################################### #
 
 # --------------------------------------------------------------------------- #
-def getShows(directory, last, db, checkFile):
+class TimeoutHTTPAdapter(HTTPAdapter):
+    '''HTTP adapter which applies a default timeout to every request'''
+
+    def __init__(self, *args, timeout=HTTP_TIMEOUT, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def createSession(poolSize=PROBE_WORKERS, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF, timeout=HTTP_TIMEOUT):
+    '''Create a HTTP session with keep-alive connection pooling and retries
+
+    :param poolSize: Maximum number of connections kept open per host
+    :type poolSize: integer
+    :param retries: Number of retries for failed requests
+    :type retries: integer
+    :param backoff: Backoff factor for the exponential delay between retries
+    :type backoff: float
+    :param timeout: Connect and read timeout in seconds
+    :type timeout: tuple
+
+    :returns: The HTTP session
+    :rtype: requests.Session
+    '''
+    retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET", "HEAD"], raise_on_status=False)
+    adapter = TimeoutHTTPAdapter(pool_connections=4, pool_maxsize=poolSize, pool_block=True, max_retries=retry, timeout=timeout)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def sessionStats(session):
+    '''Count the connections opened and reused by a session
+
+    :param session: The HTTP session
+    :type session: requests.Session
+
+    :returns: Number of connections opened and number of requests which reused a connection
+    :rtype: integer, integer
+    '''
+    opened = 0
+    sent = 0
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            opened += pool.num_connections
+            sent += pool.num_requests
+    return opened, max(0, sent - opened)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def getShows(directory, last, db, checkLevel, session, workers=PROBE_WORKERS, cache=None, segments=DOWNLOAD_SEGMENTS, remux=REMUX, exiftool=None, stages=PIPELINE_WORKERS):
     '''Download the new episodes of all shows
 
+    The shows are discovered concurrently. The episodes are downloaded,
+    post-processed and hashed in a pipeline and saved to the database in
+    ascending page index order for each show.
+
     :param directory: The path of the directory in which to save the shows
     :type directory: string
     :param last: The page IDs of the last archived episode for each show
     :type last: dictionary
     :param db: Connection to the metadata database
     :type db: sqlite3.Cursor
-    :param checkFile: Whether to perform an integrity check on the file
-    :type checkFile: boolean
-    '''
-    #Get Tagesschau
-    for i in range(last['ts20']+2, last['ts20']+80, 2):
-        url = "https://www.tagesschau.de/multimedia/sendung/ts-{}.html".format(i)
-        r = requests.get(url, allow_redirects=False)
-        if r.status_code in [404, 301]:
+    :param checkLevel: Integrity check to perform on the file (quick, sample, full or None)
+    :type checkLevel: string
+    :param session: HTTP session used for all requests
+    :type session: requests.Session
+    :param workers: Number of pages to probe in parallel
+    :type workers: integer
+    :param cache: Probe cache, see :func:`loadProbeCache`
+    :type cache: dictionary
+    :param segments: Number of parallel connections per video download
+    :type segments: integer
+    :param remux: Whether to add subtitles and tags in a single ffmpeg pass
+    :type remux: boolean
+    :param exiftool: Running exiftool worker shared by all episodes
+    :type exiftool: ExifTool
+    :param stages: Number of worker threads for the download, post-processing and hashing stages
+    :type stages: tuple of integers
+    '''
+    history = getHistory(db)
+    ids = loadIDs(db)
+    with ThreadPoolExecutor(max_workers=workers) as pool, ThreadPoolExecutor(max_workers=len(SHOWS)) as showPool:
+        #Discover all shows in parallel
+        futures = {}
+        for show in SHOWS:
+            futures[show] = showPool.submit(discoverShow, pool, session, show, last[show], history.get(show, []), workers, cache)
+        #Get episodes in order
+        def episodes():
+            for show in SHOWS:
+                for i, (dateString, desc, config) in futures[show].result():
+                    yield show, dateString, desc, config, i
+        #Download, process and hash the episodes in a pipeline, save them in order
+        fetch = lambda e: fetchShow(*e[:4], directory, e[4], session, segments)
+        process = lambda e: processShow(e, checkLevel, remux, exiftool)
+        for episode in pipeline(episodes(), [(fetch, stages[0]), (process, stages[1]), (hashShow, stages[2])]):
+            commitShow(db, directory, episode, ids)
+            last[episode["info"]["show"]] = episode["info"]["articleID"]
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def discoverShow(pool, session, show, lastID, history, workers, cache):
+    '''Probe the candidate pages of a show until all expected episodes are found
+
+    :param pool: Thread pool in which to probe the pages
+    :type pool: concurrent.futures.ThreadPoolExecutor
+    :param session: HTTP session used for all requests
+    :type session: requests.Session
+    :param show: identifier of the show (e.g. 'ts20' for main tagesschau)
+    :type show: string
+    :param lastID: Page ID of the last archived episode
+    :type lastID: integer
+    :param history: Page IDs and timestamps of the archived episodes, see :func:`getHistory`
+    :type history: list of tuples
+    :param workers: Number of pages to probe in parallel
+    :type workers: integer
+    :param cache: Probe cache, see :func:`loadProbeCache`
+    :type cache: dictionary
+
+    :returns: The page IDs and probe results of the found episodes in ascending order
+    :rtype: list of tuples
+    '''
+    candidates, expected = predictIndexes(show, lastID, history)
+    found = {}
+    for start in range(0, len(candidates), workers):
+        batch = candidates[start:start+workers]
+        futures = [pool.submit(probePage, session, show, i, cache) for i in batch]
+        for i, future in zip(batch, futures):
+            result = future.result()
+            if result:
+                found[i] = result
+        #Stop as soon as an episode for every expected air date was found
+        if expected is not None and expected <= {convertDate(r[0])[0] for r in found.values()}:
+            break
+    return sorted(found.items())
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def predictIndexes(show, lastID, history, now=None):
+    '''Predict the page IDs of the episodes aired since the last archived one
+
+    The air days, the air time and the page ID increments per weekday are
+    learned from the archived episodes. The search window grows with the
+    number of episodes missed since then. Without history the fixed probe
+    window is used.
+
+    :param show: identifier of the show (e.g. 'ts20' for main tagesschau)
+    :type show: string
+    :param lastID: Page ID of the last archived episode
+    :type lastID: integer
+    :param history: Page IDs and timestamps of the archived episodes, see :func:`getHistory`
+    :type history: list of tuples
+    :param now: Current time (default: now)
+    :type now: datetime.datetime
+
+    :returns: The candidate page IDs with the most likely first and the set of expected air dates (YYYY-MM-DD) or None if unknown
+    :rtype: list of integers, set of strings
+    '''
+    window = SHOWS[show][1]
+    schedule = learnSchedule(history)
+    if not schedule or history[-1][0] != lastID:
+        return list(range(lastID+2, lastID+window, 2)), None
+    timezone = pytz.timezone("Europe/Berlin")
+    if now is None:
+        now = datetime.now(timezone)
+    #Predict the page ID of each expected episode
+    expected = set()
+    predictions = []
+    day = datetime.fromtimestamp(history[-1][1], timezone).date()
+    index = lastID
+    while True:
+        day += timedelta(days=1)
+        airTime = timezone.localize(datetime.combine(day, datetime.min.time()) + timedelta(minutes=schedule["minute"]))
+        if airTime + timedelta(seconds=PUBLISH_DELAY) > now:
+            break
+        if day.weekday() not in schedule["weekdays"]:
             continue
+        index += schedule["increments"].get(day.weekday(), schedule["default"])
+        expected.add(day.strftime('%Y-%m-%d'))
+        predictions.append(index)
+    #Order candidates by distance to the closest prediction
+    upper = max(predictions + [lastID]) + window
+    candidates = range(lastID+2, upper, 2)
+    if predictions:
+        return sorted(candidates, key=lambda i: (min(abs(i - p) for p in predictions), i)), expected
+    return list(candidates), expected
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def learnSchedule(history):
+    '''Learn the air days, air time and page ID increments of a show
+
+    :param history: Page IDs and timestamps of the archived episodes, see :func:`getHistory`
+    :type history: list of tuples
+
+    :returns: Dict with the air weekdays, the median air time in minutes after midnight, the median page ID increment for each weekday and overall, or None if there is not enough history
+    :rtype: dictionary or None
+    '''
+    timezone = pytz.timezone("Europe/Berlin")
+    dates = [datetime.fromtimestamp(ts, timezone) for _, ts in history]
+    if len(dates) < 2:
+        return None
+    #Get regular air days
+    counts = {}
+    for d in dates:
+        counts[d.weekday()] = counts.get(d.weekday(), 0) + 1
+    weekdays = {wd for wd, c in counts.items() if c >= max(counts.values()) / 4}
+    #Get increments between consecutive episodes without outage in between
+    increments = {}
+    for (prevID, _), (nextID, _), prevDate, nextDate in zip(history, history[1:], dates, dates[1:]):
+        gap = (nextDate.date() - prevDate.date()).days
+        if gap < 1:
+            continue
+        expectedGap = 1
+        while (prevDate.weekday() + expectedGap) % 7 not in weekdays and expectedGap < 7:
+            expectedGap += 1
+        if gap == expectedGap:
+            increments.setdefault(nextDate.weekday(), []).append(nextID - prevID)
+    if not increments:
+        return None
+    evenMedian = lambda values: max(2, int(round(statistics.median(values) / 2)) * 2)
+    return {"weekdays" : weekdays,
+            "minute" : int(statistics.median(d.hour * 60 + d.minute for d in dates)),
+            "increments" : {wd : evenMedian(v) for wd, v in increments.items()},
+            "default" : evenMedian([i for v in increments.values() for i in v])}
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def getHistory(db, limit=HISTORY_SIZE):
+    '''Get the page IDs and air timestamps of the last archived episodes of each show
+
+    :param db: Connection to the metadata database
+    :type db: sqlite3.Cursor
+    :param limit: Maximum number of episodes per show
+    :type limit: integer
+
+    :returns: Dict with the show identifier as key and a list of (articleID, timestamp) tuples in ascending order as value
+    :rtype: dictionary
+    '''
+    history = {}
+    cmd = "SELECT articleID, timstamp FROM videos INNER JOIN shows ON shows.id = videos.showID WHERE shows.name=? ORDER BY articleID DESC LIMIT ?"
+    for show in SHOWS:
+        history[show] = list(reversed(db.execute(cmd, (show, limit)).fetchall()))
+    return history
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def probePage(session, show, articleID, cache=None):
+    '''Fetch and parse the page of an episode
+
+    Indexes known to contain no episode are skipped until their cache entry
+    expires, pages fetched before are revalidated with a conditional request.
+
+    :param session: HTTP session used for the request
+    :type session: requests.Session
+    :param show: identifier of the show (e.g. 'ts20' for main tagesschau)
+    :type show: string
+    :param articleID: Page ID of the episode
+    :type articleID: integer
+    :param cache: Probe cache, see :func:`loadProbeCache`
+    :type cache: dictionary
+
+    :returns: Air date, description and parsed config json or None if there is no episode
+    :rtype: tuple or None
+    '''
+    url = "https://www.tagesschau.de/multimedia/sendung/{}-{}.html".format(SHOWS[show][0], articleID)
+    now = time.time()
+    if cache is None:
+        cache = {}
+    entry = cache.get(url)
+    #Skip known dead pages
+    if entry and entry["expires"] > now:
+        return None
+    #Revalidate previously fetched pages
+    headers = {}
+    if entry and "etag" in entry:
+        headers["If-None-Match"] = entry["etag"]
+    if entry and "modified" in entry:
+        headers["If-Modified-Since"] = entry["modified"]
+    r = session.get(url, allow_redirects=False, headers=headers)
+    if r.status_code == 304 and entry:
+        result = entry["result"]
+    elif r.status_code in [404, 301]:
+        cache[url] = {"show" : show, "articleID" : articleID, "expires" : now + DEAD_TTL[r.status_code]}
+        return None
+    else:
         page = BeautifulSoup(r.text, features="html.parser")
         title = page.title.text
-        if "20:00" in title:
+        #Only archive the main tagesschau edition
+        if show == "ts20" and "20:00" not in title:
+            result = None
+        else:
             desc, config = extractDescConfig(page)
             dateString = extractDate(title)
-            content = page.body.find('div', attrs={'class' : 'inhalt'})
-            saveShow("ts20", dateString, desc, config, directory, i, db, checkFile)
-            last['ts'] = i
-    #Get Tagesthemen
-    for i in range(last['tt']+2, last['tt']+20, 2):
-        url = "https://www.tagesschau.de/multimedia/sendung/tt-{}.html".format(i)
-        r = requests.get(url, allow_redirects=False)
-        if r.status_code in [404, 301]:
-            continue
-        page = BeautifulSoup(r.text, features="html.parser")
-        title = page.title.text
-        desc, config = extractDescConfig(page)
-        dateString = extractDate(title)
-        saveShow("tt", dateString, desc, config, directory, i, db, checkFile)
-        last['tt'] = i
-    #Get Nachtmagazin
-    for i in range(last['nm']+2, last['nm']+8, 2):
-        url = "https://www.tagesschau.de/multimedia/sendung/nm-{}.html".format(i)
-        r = requests.get(url, allow_redirects=False)
-        if r.status_code in [404, 301]:
-            continue
-        page = BeautifulSoup(r.text, features="html.parser")
-        title = page.title.text
-        desc, config = extractDescConfig(page)
-        dateString = extractDate(title)
-        saveShow("nm", dateString, desc, config, directory, i, db, checkFile)
-        last['nm'] = i
+            result = [dateString, desc, config]
+        entry = {"show" : show, "articleID" : articleID, "result" : result}
+        if "ETag" in r.headers:
+            entry["etag"] = r.headers["ETag"]
+        if "Last-Modified" in r.headers:
+            entry["modified"] = r.headers["Last-Modified"]
+    entry["expires"] = 0 if result else now + DEAD_TTL["skip"]
+    cache[url] = entry
+    return tuple(result) if result else None
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def loadProbeCache(directory):
+    '''Load the probe cache stored next to the archive database
+
+    The cache maps page URLs to dicts with the show, the page index, the time
+    until which the page is not requested again and, for fetched pages, the
+    ETag/Last-Modified headers together with the parsed result.
+
+    :param directory: Path of the archive directory
+    :type directory: string
+
+    :returns: The probe cache (empty if none exists or it is unreadable)
+    :rtype: dictionary
+    '''
+    try:
+        with open(os.path.join(directory, "probecache.json"), 'r', encoding='utf8') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
 # ########################################################################### #
 
 # --------------------------------------------------------------------------- #
-def saveShow(show, dateString, desc, config, directory, articleID, db, checkFile):
+def saveProbeCache(directory, cache, last):
+    '''Remove entries which are no longer needed and save the probe cache
+
+    :param directory: Path of the archive directory
+    :type directory: string
+    :param cache: The probe cache
+    :type cache: dictionary
+    :param last: The page IDs of the last archived episode for each show
+    :type last: dictionary
+    '''
+    now = time.time()
+    cache = {url : entry for url, entry in cache.items() if entry["articleID"] > last.get(entry["show"], 0) and (entry["expires"] > now or "result" in entry)}
+    cacheFile = os.path.join(directory, "probecache.json")
+    tmpFile = cacheFile + ".tmp"
+    with open(tmpFile, 'w', encoding='utf8') as f:
+        json.dump(cache, f)
+    os.replace(tmpFile, cacheFile)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def saveShow(show, dateString, desc, config, directory, articleID, db, checkLevel, session, segments=DOWNLOAD_SEGMENTS, remux=REMUX, exiftool=None):
     '''Download an episode of a show, parse the metadata and save them to the database
 
     :param show: identifier of the show (e.g. 'ts20' for main tagesschau)
@@ -169,8 +630,49 @@ def saveShow(show, dateString, desc, config, directory, articleID, db, checkFile
     :type articleID: integer
     :param db: Connection to the metadata database
     :type db: sqlite3.Cursor
-    :param checkFile: Whether to perform an integrity check on the file
-    :type checkFile: boolean
+    :param checkLevel: Integrity check to perform on the file (quick, sample, full or None)
+    :type checkLevel: string
+    :param session: HTTP session used for all downloads
+    :type session: requests.Session
+    :param segments: Number of parallel connections for the video download
+    :type segments: integer
+    :param remux: Whether to add subtitles and tags in a single ffmpeg pass
+    :type remux: boolean
+    :param exiftool: Running exiftool worker shared by all episodes
+    :type exiftool: ExifTool
+    '''
+    episode = fetchShow(show, dateString, desc, config, directory, articleID, session, segments)
+    episode = processShow(episode, checkLevel, remux, exiftool)
+    episode = hashShow(episode)
+    commitShow(db, directory, episode)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def fetchShow(show, dateString, desc, config, directory, articleID, session, segments=DOWNLOAD_SEGMENTS):
+    '''Parse the metadata of an episode and download its subtitles and video
+
+    The video is saved under a temporary name, the final name is assigned by
+    :func:`commitShow`.
+
+    :param show: identifier of the show (e.g. 'ts20' for main tagesschau)
+    :type show: string
+    :param dateString: Air date and time in the form DD.MM.YYYY HH:MM
+    :type dateString: string
+    :param desc: Episode description
+    :type desc: string
+    :param config: Parsed episode config json
+    :type config: dict
+    :param directory: The path of the directory in which to save the video
+    :type directory: string
+    :param articleID: Page ID of the episode
+    :type articleID: integer
+    :param session: HTTP session used for all downloads
+    :type session: requests.Session
+    :param segments: Number of parallel connections for the video download
+    :type segments: integer
+
+    :returns: The episode with the keys info, date, videoFile, rawSubs, subtitles and transcript
+    :rtype: dictionary
     '''
     #Convert date
     [date, timestamp, localtime, metadate] = convertDate(dateString)
@@ -201,7 +703,7 @@ def saveShow(show, dateString, desc, config, directory, articleID, db, checkFile
         subtitleURL = config["mc"]["_subtitleUrl"]
         if not subtitleURL.startswith("http"):
             subtitleURL = "https://www.tagesschau.de" + subtitleURL
-        r = requests.get(subtitleURL)
+        r = session.get(subtitleURL)
         r.raise_for_status()
         rawSubs = r.text
         [subtitles, transcript] = subconvert.convertEBU(rawSubs)
@@ -215,44 +717,828 @@ def saveShow(show, dateString, desc, config, directory, articleID, db, checkFile
     except IndexError:
         pass
     #Save video
+    videoFile = os.path.join(directory, "{}_{}.download.mp4".format(show, articleID))
+    if segments > 1:
+        info["downloadChecksum"] = downloadSegmented(session, videoURL, videoFile, segments)
+    else:
+        info["downloadChecksum"] = downloadFile(session, videoURL, videoFile)
+    return {"info" : info, "date" : date, "videoFile" : videoFile, "rawSubs" : rawSubs, "subtitles" : subtitles, "transcript" : transcript}
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def processShow(episode, checkLevel, remux=REMUX, exiftool=None):
+    '''Add the subtitles and metadata to the video of an episode and check its integrity
+
+    :param episode: The episode as returned by :func:`fetchShow`
+    :type episode: dictionary
+    :param checkLevel: Integrity check to perform on the file (quick, sample, full or None)
+    :type checkLevel: string
+    :param remux: Whether to add subtitles and tags in a single ffmpeg pass
+    :type remux: boolean
+    :param exiftool: Running exiftool worker shared by all episodes
+    :type exiftool: ExifTool
+
+    :returns: The episode
+    :rtype: dictionary
+    '''
+    info = episode["info"]
+    videoFile = episode["videoFile"]
+    #Add meta data
+    if os.path.isfile(videoFile):
+        if remux:
+            remuxMetadata(info, videoFile, episode["subtitles"], exiftool)
+        else:
+            writeMetadata(info, videoFile, episode["subtitles"], exiftool)
+    #Check file integrity
+    if checkLevel:
+        info["checkLevel"] = checkLevel
+        info["checkPassed"] = checkVideo(videoFile, checkLevel)
+        if info["checkPassed"]:
+            print("File \"{}\" {} check passed".format(videoFile, checkLevel))
+        else:
+            print("ERROR: File \"{}\" corrupt!".format(videoFile))
+    return episode
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def hashShow(episode):
+    '''Calculate the checksum and the chunk digests of the final video of an episode
+
+    :param episode: The episode as returned by :func:`processShow`
+    :type episode: dictionary
+
+    :returns: The episode
+    :rtype: dictionary
+    '''
+    episode["info"]["checksum"], episode["info"]["chunks"] = hashFile(episode["videoFile"], chunkSize=CHUNK_SIZE)
+    return episode
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def commitShow(db, directory, episode, ids=None):
+    '''Move the video of an episode to its final name and save the metadata to the database
+
+    The metadata of each episode is committed in its own transaction.
+
+    :param db: Connection to the metadata database
+    :type db: sqlite3.Cursor
+    :param directory: The path of the directory in which to save the video
+    :type directory: string
+    :param episode: The episode as returned by :func:`hashShow`
+    :type episode: dictionary
+    :param ids: Cached show and presenter IDs, see :func:`loadIDs`
+    :type ids: dictionary
+    '''
+    info = episode["info"]
+    show = info["show"]
+    date = episode["date"]
     info["videoName"] = "{}_{}.mp4".format(show, date)
-    videoFile = os.path.join(directory, info["videoName"])
     i = 1
     #Check if file already exists
     while checkFilename(info["videoName"], db):
         i += 1
         info["videoName"] = "{}_{}_{}.mp4".format(show, date, i)
-        videoFile = os.path.join(directory, info["videoName"])
-    with requests.get(videoURL, stream=True) as r:
+    os.replace(episode["videoFile"], os.path.join(directory, info["videoName"]))
+    #Write info
+    saveToDB(db, info, episode["rawSubs"], episode["subtitles"], ids)
+    db.connection.commit()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def pipeline(items, stages, queueSize=PIPELINE_QUEUE):
+    '''Pass items through a chain of stages, each running in its own worker threads
+
+    The stages are connected by bounded queues. The results are yielded in
+    the order of the items. An exception raised by a stage (or while getting
+    the items), including KeyboardInterrupt and SystemExit, is re-raised
+    when its item is due.
+
+    :param items: The items to process (consumed in a separate thread)
+    :type items: iterable
+    :param stages: List of (function, number of worker threads) tuples
+    :type stages: list of tuples
+    :param queueSize: Maximum number of items waiting in front of each stage
+    :type queueSize: integer
+
+    :returns: The processed items
+    :rtype: generator
+    '''
+    queues = [queue.Queue(maxsize=queueSize) for _ in stages] + [queue.Queue()]
+    finished = [0] * len(stages)
+    lock = threading.Lock()
+
+    def feed():
+        n = 0
+        try:
+            for item in items:
+                queues[0].put((n, item, None))
+                n += 1
+        except BaseException as e:
+            queues[0].put((n, None, e))
+        finally:
+            for _ in range(stages[0][1]):
+                queues[0].put(None)
+
+    def work(k):
+        func = stages[k][0]
+        try:
+            while True:
+                job = queues[k].get()
+                if job is None:
+                    break
+                n, item, error = job
+                if error is None:
+                    try:
+                        item = func(item)
+                    except BaseException as e:
+                        #Passed on and re-raised in the main thread (also KeyboardInterrupt and SystemExit)
+                        error = e
+                queues[k+1].put((n, item, error))
+        finally:
+            #Last worker of this stage stops the next one
+            with lock:
+                finished[k] += 1
+                if finished[k] == stages[k][1]:
+                    for _ in range(stages[k+1][1] if k+1 < len(stages) else 1):
+                        queues[k+1].put(None)
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for k, (_, workers) in enumerate(stages):
+        threads += [threading.Thread(target=work, args=(k,), daemon=True) for _ in range(workers)]
+    for t in threads:
+        t.start()
+    #Yield results in order
+    pending = {}
+    n = 0
+    while True:
+        job = queues[-1].get()
+        if job is None:
+            break
+        pending[job[0]] = job[1:]
+        while n in pending:
+            item, error = pending.pop(n)
+            n += 1
+            if error is not None:
+                raise error
+            yield item
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def remoteSize(session, url, response=None):
+    '''Get the size of a remote file
+
+    The size is taken from the Content-Range header of a 416 response if given, otherwise from a HEAD request.
+
+    :param session: HTTP session
+    :type session: requests.Session
+    :param url: URL of the file
+    :type url: string
+    :param response: Response to a range request
+    :type response: requests.Response
+
+    :returns: Size in bytes or None if unknown
+    :rtype: integer
+    '''
+    try:
+        if response is not None and "Content-Range" in response.headers:
+            return int(response.headers["Content-Range"].rsplit('/', 1)[1])
+        r = session.head(url, allow_redirects=True)
         r.raise_for_status()
-        with open(videoFile, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-                    f.flush()
-    #Add meta data
-    if os.path.isfile(videoFile):
-        writeMetadata(info, videoFile, subtitles)
-    #Check file integrity
-    if checkFile:
-        cmd = ["ffmpeg", "-v", "error", "-i", videoFile, "-f", "null", "-"]
-        out, _ = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()
-        if out:
-            print("ERROR: File \"{}\" corrupt!".format(videoFile))
-        else:
-            print("File \"{}\" check passed".format(videoFile))
-    #Calculate checksum
+        return int(r.headers["Content-Length"])
+    except (KeyError, ValueError, requests.exceptions.RequestException):
+        return None
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def downloadFile(session, url, path, chunkSize=DOWNLOAD_CHUNK, retries=DOWNLOAD_RETRIES):
+    '''Download a file, resuming interrupted transfers with range requests
+
+    The data is written to PATH.part, which is renamed to PATH once the
+    size matches the one announced by the server. A .part file left over
+    by a previous run is resumed as well.
+
+    :param session: HTTP session used for the download
+    :type session: requests.Session
+    :param url: URL of the file
+    :type url: string
+    :param path: Path at which to save the file
+    :type path: string
+    :param chunkSize: Size of the chunks in which to write the file in bytes
+    :type chunkSize: integer
+    :param retries: Number of times to resume the transfer after an error
+    :type retries: integer
+
+    :raises: :class:``requests.exceptions.RequestException: Download failed
+    :raises: :class:``IOError: Downloaded file incomplete
+
+    :returns: SHA-256 checksum of the downloaded file, computed while downloading
+    :rtype: string
+    '''
+    partFile = path + ".part"
+    attempt = 0
     sha256 = hashlib.sha256()
-    with open(videoFile, "rb") as vf:
-        for chunk in iter(lambda: vf.read(4096), b""):
-            sha256.update(chunk)
-    info["checksum"] = sha256.hexdigest()
-    #Write info
-    saveToDB(db, info, rawSubs, transcript, subtitles)
+    hashed = 0
+    while True:
+        try:
+            offset = os.path.getsize(partFile)
+        except OSError:
+            offset = 0
+        headers = {"Range" : "bytes={}-".format(offset)} if offset else {}
+        try:
+            with session.get(url, stream=True, headers=headers) as r:
+                #Range starts at the end of the file: part file from a previous run already complete
+                if r.status_code == 416:
+                    if offset == remoteSize(session, url, r):
+                        os.replace(partFile, path)
+                        return hashFile(path)
+                    #Server can't resume: start over
+                    os.remove(partFile)
+                    continue
+                r.raise_for_status()
+                if r.status_code == 206:
+                    total = int(r.headers["Content-Range"].rsplit('/', 1)[1])
+                    mode = 'ab'
+                    #Part file from a previous run: hash existing data
+                    if hashed != offset:
+                        sha256 = hashlib.sha256()
+                        hashed = 0
+                        with open(partFile, 'rb') as f:
+                            for chunk in iter(lambda: f.read(chunkSize), b""):
+                                sha256.update(chunk)
+                                hashed += len(chunk)
+                else:
+                    total = int(r.headers["Content-Length"]) if "Content-Length" in r.headers else None
+                    mode = 'wb'
+                    sha256 = hashlib.sha256()
+                    hashed = 0
+                with open(partFile, mode) as f:
+                    for chunk in r.iter_content(chunk_size=chunkSize):
+                        f.write(chunk)
+                        sha256.update(chunk)
+                        hashed += len(chunk)
+            break
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout):
+            attempt += 1
+            if attempt > retries:
+                raise
+            print("Download interrupted, resuming ({}/{})".format(attempt, retries))
+            time.sleep(HTTP_BACKOFF * 2 ** attempt)
+    #Verify size
+    size = os.path.getsize(partFile)
+    if total is not None and size != total:
+        raise IOError("Incomplete download of \"{}\" ({} of {} bytes)".format(url, size, total))
+    os.replace(partFile, path)
+    return sha256.hexdigest()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def downloadSegmented(session, url, path, segments=DOWNLOAD_SEGMENTS, chunkSize=DOWNLOAD_CHUNK, retries=DOWNLOAD_RETRIES, rateLimit=SEGMENT_RATE):
+    '''Download a file over multiple connections, each fetching a byte range
+
+    The segments are written directly into a preallocated PATH.part file.
+    The progress of each segment is kept in PATH.part.json so an interrupted
+    download can be resumed. After an error or interruption the other segments
+    stop after their current chunk. Falls back to :func:`downloadFile` if the server
+    doesn't support range requests or the file is too small.
+
+    :param session: HTTP session used for the download
+    :type session: requests.Session
+    :param url: URL of the file
+    :type url: string
+    :param path: Path at which to save the file
+    :type path: string
+    :param segments: Number of segments to download in parallel
+    :type segments: integer
+    :param chunkSize: Size of the chunks in which to write the file in bytes
+    :type chunkSize: integer
+    :param retries: Number of times to resume each segment after an error
+    :type retries: integer
+    :param rateLimit: Maximum bandwidth per connection in bytes/s (None: unlimited)
+    :type rateLimit: integer
+
+    :raises: :class:``requests.exceptions.RequestException: Download failed
+    :raises: :class:``IOError: Downloaded file incomplete
+
+    :returns: SHA-256 checksum of the downloaded file
+    :rtype: string
+    '''
+    r = session.head(url, allow_redirects=True)
+    r.raise_for_status()
+    size = int(r.headers.get("Content-Length", 0))
+    segments = min(segments, size // SEGMENT_MIN)
+    if segments < 2 or r.headers.get("Accept-Ranges") != "bytes":
+        return downloadFile(session, url, path, chunkSize, retries)
+    partFile = path + ".part"
+    stateFile = partFile + ".json"
+    bounds = [(k * size // segments, (k+1) * size // segments) for k in range(segments)]
+    progress = [start for start, _ in bounds]
+    #Resume previous download
+    try:
+        with open(stateFile, 'r') as f:
+            state = json.load(f)
+        if state["size"] == size and state["bounds"] == [list(b) for b in bounds] and os.path.getsize(partFile) == size:
+            progress = state["progress"]
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    #Preallocate file
+    if progress == [start for start, _ in bounds]:
+        with open(partFile, 'wb') as f:
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(f.fileno(), 0, size)
+            else:
+                f.truncate(size)
+
+    #Set to stop all segments after an error or interruption
+    stop = threading.Event()
+
+    def fetch(k):
+        end = bounds[k][1]
+        attempt = 0
+        while progress[k] < end and not stop.is_set():
+            try:
+                headers = {"Range" : "bytes={}-{}".format(progress[k], end - 1)}
+                with session.get(url, stream=True, headers=headers) as r:
+                    r.raise_for_status()
+                    if r.status_code != 206:
+                        raise IOError("Server ignored range request for \"{}\"".format(url))
+                    with open(partFile, 'r+b') as f:
+                        f.seek(progress[k])
+                        startTime = time.monotonic()
+                        received = 0
+                        for chunk in r.iter_content(chunk_size=chunkSize):
+                            chunk = chunk[:end - progress[k]]
+                            f.write(chunk)
+                            progress[k] += len(chunk)
+                            received += len(chunk)
+                            if stop.is_set():
+                                break
+                            #Throttle connection
+                            if rateLimit:
+                                delay = received / rateLimit - (time.monotonic() - startTime)
+                                if delay > 0:
+                                    stop.wait(delay)
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout):
+                attempt += 1
+                if attempt > retries:
+                    raise
+                stop.wait(HTTP_BACKOFF * 2 ** attempt)
+
+    pool = ThreadPoolExecutor(max_workers=segments)
+    futures = []
+    try:
+        futures = [pool.submit(fetch, k) for k in range(segments)]
+        for future in futures:
+            future.result()
+    except BaseException:
+        #Don't start waiting segments, let running ones stop after their current chunk
+        stop.set()
+        for future in futures:
+            future.cancel()
+        raise
+    finally:
+        #Progress is only consistent once all segments have stopped
+        pool.shutdown(wait=True)
+        with open(stateFile, 'w') as f:
+            json.dump({"size" : size, "bounds" : bounds, "progress" : progress}, f)
+    #Verify size
+    missing = sum(end - done for (_, end), done in zip(bounds, progress))
+    if missing or os.path.getsize(partFile) != size:
+        raise IOError("Incomplete download of \"{}\" ({} bytes missing)".format(url, missing))
+    os.remove(stateFile)
+    os.replace(partFile, path)
+    #Segments arrive out of order, hash the freshly written (still cached) file
+    return hashFile(path)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def hashFile(path, bufferSize=HASH_BUFFER, chunkSize=None):
+    '''Calculate the SHA-256 checksum of a file
+
+    :param path: Path of the file
+    :type path: string
+    :param bufferSize: Number of bytes to read at once
+    :type bufferSize: integer
+    :param chunkSize: If given, additionally calculate the SHA-256 digest of each chunk of this size
+    :type chunkSize: integer
+
+    :returns: SHA-256 checksum as hex string (and list of chunk digests if chunkSize is given)
+    :rtype: string or (string, list of bytes)
+    '''
+    sha256 = hashlib.sha256()
+    chunks = [] if chunkSize else None
+    buffer = bytearray(bufferSize)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            sha256.update(view[:n])
+            if chunkSize:
+                updateChunks(chunks, view[:n], chunkSize)
+    if chunkSize:
+        return sha256.hexdigest(), finishChunks(chunks)
+    return sha256.hexdigest()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def hashChunks(path, first, count, chunkSize=CHUNK_SIZE, bufferSize=HASH_BUFFER):
+    '''Calculate the SHA-256 digests of a range of chunks of a file
+
+    :param path: Path of the file
+    :type path: string
+    :param first: Index of the first chunk
+    :type first: integer
+    :param count: Number of chunks
+    :type count: integer
+    :param chunkSize: Size of the chunks in bytes
+    :type chunkSize: integer
+    :param bufferSize: Number of bytes to read at once
+    :type bufferSize: integer
+
+    :returns: The chunk digests (fewer than count if the file ends before)
+    :rtype: list of bytes
+    '''
+    chunks = []
+    remaining = count * chunkSize
+    buffer = bytearray(min(bufferSize, remaining))
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        f.seek(first * chunkSize)
+        while remaining > 0:
+            n = f.readinto(view[:min(len(buffer), remaining)])
+            if not n:
+                break
+            updateChunks(chunks, view[:n], chunkSize)
+            remaining -= n
+    return finishChunks(chunks)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def updateChunks(chunks, data, chunkSize):
+    '''Feed data into the chunk hashes, starting a new chunk when the current one is full
+
+    :param chunks: List of [sha256 object, bytes hashed] of the chunks so far
+    :type chunks: list
+    :param data: The data
+    :type data: memoryview
+    :param chunkSize: Size of the chunks in bytes
+    :type chunkSize: integer
+    '''
+    while data:
+        if not chunks or chunks[-1][1] == chunkSize:
+            chunks.append([hashlib.sha256(), 0])
+        n = min(len(data), chunkSize - chunks[-1][1])
+        chunks[-1][0].update(data[:n])
+        chunks[-1][1] += n
+        data = data[n:]
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def finishChunks(chunks):
+    '''Get the digests of the chunks fed with :func:`updateChunks`
+
+    :param chunks: List of [sha256 object, bytes hashed] of the chunks
+    :type chunks: list
+
+    :returns: The chunk digests
+    :rtype: list of bytes
+    '''
+    return [c[0].digest() for c in chunks]
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def chunkRoot(chunks):
+    '''Calculate the root hash over the chunk digests of a file
+
+    :param chunks: The chunk digests
+    :type chunks: list of bytes
+
+    :returns: SHA-256 of the concatenated chunk digests as hex string
+    :rtype: string
+    '''
+    return hashlib.sha256(b"".join(chunks)).hexdigest()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def compressSubtitles(raw):
+    '''Compress raw subtitles for storing them in the database
+
+    :param raw: Raw subtitles
+    :type raw: string
+
+    :returns: Compression method and the compressed subtitles
+    :rtype: tuple
+    '''
+    return ("zlib", zlib.compress(raw.encode("utf8"), SUBTITLE_COMPRESSION))
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def decompressSubtitles(compression, data):
+    '''Decompress raw subtitles stored in the database
+
+    :param compression: Compression method, None if uncompressed
+    :type compression: string
+    :param data: The stored subtitles
+    :type data: bytes
+
+    :raises: :class:``ValueError: Unknown compression method
+
+    :returns: Raw subtitles
+    :rtype: string
+    '''
+    if compression == "zlib":
+        return zlib.decompress(data).decode("utf8")
+    elif compression is None:
+        return data.decode("utf8") if isinstance(data, bytes) else data
+    raise ValueError("Unknown subtitle compression \"{}\"".format(compression))
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def getSubtitles(db, subtitleID):
+    '''Get the subtitles of an episode from the database
+
+    The SRT subtitles and the transcript are derived from the stored raw subtitles with
+    :mod:`subconvert`, the results for the SUBTITLE_CACHE most recently requested episodes
+    are cached by subtitle ID until the subtitles are written, see :func:`clearSubtitles`.
+
+    :param db: Connection to the metadata database
+    :type db: sqlite3.Cursor
+    :param subtitleID: ID of the subtitles
+    :type subtitleID: integer
+
+    :returns: Tuple with the raw subtitles, the srt subtitles and the transcript or None if not found
+    :rtype: tuple of strings
+    '''
+    with SUBTITLES_LOCK:
+        if subtitleID in SUBTITLES:
+            SUBTITLES.move_to_end(subtitleID)
+            return SUBTITLES[subtitleID]
+    r = db.execute("SELECT format, compression, raw FROM subtitles WHERE id = ?;", (subtitleID,)).fetchone()
+    if not r:
+        return None
+    subtitles = convertSubtitles(*r)
+    with SUBTITLES_LOCK:
+        SUBTITLES[subtitleID] = subtitles
+        while len(SUBTITLES) > SUBTITLE_CACHE:
+            SUBTITLES.popitem(last=False)
+    return subtitles
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def clearSubtitles(subtitleID=None):
+    '''Remove subtitles from the cache of :func:`getSubtitles` after they were written
+
+    :param subtitleID: ID of the subtitles (None: clear the whole cache)
+    :type subtitleID: integer
+    '''
+    with SUBTITLES_LOCK:
+        if subtitleID is None:
+            SUBTITLES.clear()
+        else:
+            SUBTITLES.pop(subtitleID, None)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def convertSubtitles(subFormat, compression, data):
+    '''Decompress stored subtitles and convert them to the SRT format
+
+    :param subFormat: Format of the raw subtitles ("ebu" or "vtt")
+    :type subFormat: string
+    :param compression: Compression method, see :func:`decompressSubtitles`
+    :type compression: string
+    :param data: The stored subtitles
+    :type data: bytes
+
+    :returns: Tuple with the raw subtitles, the srt subtitles and the transcript
+    :rtype: tuple of strings
+    '''
+    raw = decompressSubtitles(compression, data)
+    if subFormat == "vtt":
+        subs = subconvert.parseVTT(raw)
+    else:
+        subs = subconvert.parseEBU(raw)
+    return tuple([raw] + subconvert.generateSrt(subs))
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def indexEpisode(db, videoID, srt, topics=None, note=None):
+    '''Add an episode to the full-text search index
+
+    Each SRT cue is a separate row, so matches can be located in the video.
+    Topics and note share the first row, which is always added to mark the episode as indexed.
+
+    :param db: Connection to the metadata database
+    :type db: sqlite3.Cursor
+    :param videoID: ID of the video
+    :type videoID: integer
+    :param srt: Subtitles in the SRT format
+    :type srt: string
+    :param topics: Topics of the episode
+    :type topics: string
+    :param note: Note of the episode
+    :type note: string
+    '''
+    base = videoID * SEARCH_CUES
+    rows = [(base, "\n".join(t for t in [topics, note] if t))]
+    rows += [(base + number, text) for number, _, _, text in srtCues(srt) if number < SEARCH_CUES]
+    db.executemany("INSERT INTO search(rowid, text) VALUES(?,?)", rows)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def srtCues(srt):
+    '''Split SRT subtitles into cues
+
+    :param srt: Subtitles in the SRT format
+    :type srt: string
+
+    :returns: Tuples with the cue number, begin and end time code and the text without formatting
+    :rtype: generator of tuples
+    '''
+    for match in SRT_CUE.finditer(srt or ""):
+        yield (int(match.group(1)), match.group(2), match.group(3), re.sub(r"<[^>]*>", "", match.group(4)))
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def searchVersion():
+    '''Get the version of the cue numbering in the search index
+
+    The cue numbers depend on the subtitle conversion and on the ignore list,
+    the index has to be rebuilt if either of them changes.
+
+    :returns: SHA-256 checksum of the conversion version and the ignore list
+    :rtype: string
+    '''
+    sha256 = hashlib.sha256(str(subconvert.CONVERT_VERSION).encode())
+    try:
+        with open(subconvert.IGNORE_FILE, 'rb') as f:
+            sha256.update(f.read())
+    except IOError:
+        pass
+    return sha256.hexdigest()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def saveChunks(db, videoID, chunks, chunkSize=CHUNK_SIZE):
+    '''Save the chunk digests of a video
+
+    :param db: Connection to the metadata database
+    :type db: sqlite3.Cursor
+    :param videoID: ID of the video in the videos table
+    :type videoID: integer
+    :param chunks: The chunk digests
+    :type chunks: list of bytes
+    :param chunkSize: Size of the chunks in bytes
+    :type chunkSize: integer
+
+    :raises: :class:``sqlite3.Error: Unable to save chunk digests
+    '''
+    db.execute("INSERT OR REPLACE INTO chunks(videoID, chunkSize, root, hashes) VALUES(?,?,?,?);", (videoID, chunkSize, chunkRoot(chunks), b"".join(chunks)))
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def getTags(info):
+    '''Get the metadata tags for an episode
+
+    :param info: All the metadate for an episode
+    :type info: dictionary
+
+    :returns: List of exiftool tag names and values
+    :rtype: list of tuples
+    '''
+    #Get title and album
+    if info["show"] == "ts20":
+        album = "tagesschau"
+        title = "tagesschau 20:00 Uhr"
+    elif info["show"] == "tt":
+        album = "tagesthemen"
+        title = album
+    elif info["show"] == "nm":
+        album = "nachtmagazin"
+        title = album
+    else:
+        raise Exception()
+    tags = [("Artist", "ARD"),
+            ("Album", album),
+            ("Title", title),
+            ("TVShow", album),
+            ("TVNetworkName", "Das Erste"),
+            ("Genre", "Nonfiction"),
+            ("HDVideo", "Yes"),
+            ("MediaType", "TV Show")]
+    if "metadate" in info:
+        tags.append(("ContentCreateDate", info["metadate"]))
+    if "topics" in info:
+        tags.append(("LongDescription", info["topics"]))
+    if "note" in info:
+        tags.append(("Comment", info["note"]))
+    return tags
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def remuxMetadata(info, videoFile, subtitles, exiftool=None):
+    '''Add the subtitles and write the metadata into the video file in a single ffmpeg pass
+
+    The subtitles are piped into ffmpeg, existing metadata is dropped and the
+    same tags as with :func:`writeMetadata` are written. Falls back to
+    :func:`writeMetadata` if ffmpeg fails.
+
+    :param info: All the metadate for an episode
+    :type info: dictionary
+    :param videoFile: Path of the video file
+    :type videoFile: string
+    :param subtitles: Subtitles in the SRT format
+    :type subtitles: string
+    :param exiftool: Running exiftool worker used for the fallback
+    :type exiftool: ExifTool
+    '''
+    videoFileComp = os.path.splitext(videoFile)
+    tmpFile = videoFileComp[0] + "_tmp" + videoFileComp[1]
+    cmd = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-i", videoFile]
+    if subtitles:
+        cmd += ["-f", "srt", "-sub_charenc", "UTF-8", "-i", "pipe:0"]
+    cmd += ["-map", "0:v", "-map", "0:a"]
+    if subtitles:
+        cmd += ["-map", "1"]
+    cmd += ["-c", "copy"]
+    if subtitles:
+        cmd += ["-c:s:0", "mov_text", "-metadata:s:s:0", "language=deu"]
+    cmd += ["-metadata:s:a:0", "language=deu", "-map_metadata", "-1", "-map_chapters", "-1", "-fflags", "+bitexact"]
+    for tag, value in getTags(info):
+        if tag == "HDVideo":
+            value = 1 if value == "Yes" else 0
+        elif tag == "MediaType":
+            value = 10
+        elif tag == "ContentCreateDate":
+            #Same conversion as exiftool: YYYY:MM:DD HH:MM:SS+HH:MM -> YYYY-MM-DDTHH:MM:SS+HH:MM
+            value = "{}T{}".format(value[:10].replace(':', '-'), value[11:].replace(' ', ''))
+        cmd += ["-metadata", "{}={}".format(FFMPEG_TAGS[tag], value)]
+    cmd.append(tmpFile)
+    process = subprocess.run(cmd, input=subtitles.encode("utf8") if subtitles else None, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        print("ERROR: Remuxing \"{}\" failed, falling back to exiftool: {}".format(videoFile, process.stderr.decode("utf8", "replace").strip()))
+        if os.path.isfile(tmpFile):
+            os.remove(tmpFile)
+        writeMetadata(info, videoFile, subtitles, exiftool)
+        return
+    os.replace(tmpFile, videoFile)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def checkVideo(path, level="full"):
+    '''Check the integrity of a video file
+
+    quick: check the container structure with ffprobe and demux all packets
+    without decoding them, sample: additionally decode a few random windows,
+    full: decode every frame.
+
+    :param path: Path of the video file
+    :type path: string
+    :param level: Check level (quick, sample or full)
+    :type level: string
+
+    :returns: True if check passed, otherwise False
+    :rtype: boolean
+    '''
+    if level == "full":
+        return not runCheck(["ffmpeg", "-v", "error", "-i", path, "-f", "null", "-"])
+    #Check container structure
+    cmd = ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", path]
+    process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        duration = float(process.stdout.strip())
+    except ValueError:
+        return False
+    if process.returncode != 0 or process.stderr or duration <= 0:
+        return False
+    #Demux all packets
+    if runCheck(["ffmpeg", "-v", "error", "-i", path, "-map", "0", "-c", "copy", "-f", "null", "-"]):
+        return False
+    #Decode random windows
+    if level == "sample":
+        for _ in range(SAMPLE_WINDOWS):
+            start = random.uniform(0, max(0, duration - SAMPLE_LENGTH))
+            if runCheck(["ffmpeg", "-v", "error", "-ss", "{:.3f}".format(start), "-i", path, "-t", str(SAMPLE_LENGTH), "-f", "null", "-"]):
+                return False
+    return True
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def runCheck(cmd):
+    '''Run an ffmpeg check command
+
+    :param cmd: The command
+    :type cmd: list of strings
+
+    :returns: The reported errors (empty if none)
+    :rtype: bytes
+    '''
+    out, _ = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()
+    return out
 # ########################################################################### #
 
 # --------------------------------------------------------------------------- #
-def writeMetadata(info, videoFile, subtitles):
+def writeMetadata(info, videoFile, subtitles, exiftool=None):
     '''Write the metadata into the video file
 
     :param info: All the metadate for an episode
@@ -261,6 +1547,8 @@ def writeMetadata(info, videoFile, subtitles):
     :type videoFile: string
     :param subtitles: Subtitles in the SRT format
     :type subtitles: string
+    :param exiftool: Running exiftool worker (default: start one for this file)
+    :type exiftool: ExifTool
     '''
     #Add subtitles
     if subtitles:
@@ -277,68 +1565,128 @@ def writeMetadata(info, videoFile, subtitles):
         process.wait()
         shutil.move(tmpFile, videoFile)
         os.remove(subtitleFile)
-    #Get title and album
-    if info["show"] == "ts20":
-        album = "tagesschau"
-        title = "tagesschau 20:00 Uhr"
-    elif info["show"] == "tt":
-        album = "tagesthemen"
-        title = album
-    elif info["show"] == "nm":
-        album = "nachtmagazin"
-        title = album
+    #Clear existing meta data and write metadata
+    if exiftool is None:
+        with ExifTool() as exiftool:
+            writeTags(exiftool, info, videoFile)
     else:
-        raise Exception()
-    #Clear existing meta data
-    cmd = ["exiftool", "-all=", "-overwrite_original", videoFile]
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    process.wait()
-    #Write metadata
-    cmd = ["exiftool"]
-    cmd.append("-overwrite_original")
-    cmd.append("-Artist=ARD")
-    cmd.append("-Album=" + album)
-    cmd.append("-Title=" + title)
-    cmd.append("-TVShow=" + album)
-    cmd.append("-TVNetworkName=Das Erste")
-    cmd.append("-Genre=Nonfiction")
-    cmd.append("-HDVideo=Yes")
-    cmd.append("-MediaType=TV Show")
-    if "metadate" in info:
-        cmd.append("-ContentCreateDate='{}'".format(info["metadate"]))
-    if "topics" in info:
-        cmd.append("-LongDescription={}".format(info["topics"]))
-    if "note" in info:
-        cmd.append("-Comment={}".format(info["note"]))
-    cmd.append(videoFile)
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    process.wait()
+        writeTags(exiftool, info, videoFile)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def writeTags(exiftool, info, videoFile):
+    '''Replace the metadata of the video file with the tags of the episode using exiftool
+
+    :param exiftool: Running exiftool worker
+    :type exiftool: ExifTool
+    :param info: All the metadate for an episode
+    :type info: dictionary
+    :param videoFile: Path of the video file
+    :type videoFile: string
+    '''
+    exiftool.execute("-all=", "-overwrite_original", videoFile)
+    args = ["-overwrite_original"]
+    for tag, value in getTags(info):
+        args.append("-{}={}".format(tag, value))
+    args.append(videoFile)
+    exiftool.execute(*args)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+class ExifTool:
+    '''Long-lived exiftool process driven with -stay_open
+
+    The process is started on the first command and is shared by all
+    threads, commands are executed one at a time. Can be used as context
+    manager to stop the process afterwards.
+
+    :param executable: Name or path of the exiftool executable
+    :type executable: string
+    '''
+
+    def __init__(self, executable="exiftool"):
+        self.executable = executable
+        self.process = None
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def execute(self, *args):
+        '''Execute an exiftool command
+
+        :param args: The command line arguments of the command
+        :type args: strings
+
+        :raises: :class:``IOError: exiftool process died
+
+        :returns: The output of the command
+        :rtype: string
+        '''
+        #Arguments are passed line by line, run commands with line breaks in a separate process
+        if any('\n' in a or '\r' in a for a in args):
+            process = subprocess.run([self.executable] + list(args), stdout=subprocess.PIPE)
+            return process.stdout.decode("utf8", "replace")
+        with self.lock:
+            if self.process is None or self.process.poll() is not None:
+                self.process = subprocess.Popen([self.executable, "-stay_open", "True", "-@", "-"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self.counter += 1
+            ready = "{{ready{}}}".format(self.counter).encode()
+            command = "\n".join(list(args) + ["-execute{}".format(self.counter)]) + "\n"
+            self.process.stdin.write(command.encode("utf8"))
+            self.process.stdin.flush()
+            output = []
+            while True:
+                line = self.process.stdout.readline()
+                if not line:
+                    raise IOError("exiftool process died")
+                if line.rstrip() == ready:
+                    break
+                output.append(line)
+        return b"".join(output).decode("utf8", "replace")
+
+    def close(self):
+        '''Stop the exiftool process'''
+        with self.lock:
+            if self.process is not None and self.process.poll() is None:
+                self.process.stdin.write(b"-stay_open\nFalse\n")
+                self.process.stdin.flush()
+                self.process.communicate()
+            self.process = None
 # ########################################################################### #
 
 # --------------------------------------------------------------------------- #
-def saveToDB(db, info, raw, trans, srt):
-    '''Write the metadata to the database
+def saveToDB(db, info, raw, srt, ids=None):
+    '''Write the metadata to the database and add the episode to the search index
+
+    Only the compressed raw subtitles are stored, see :func:`getSubtitles`.
 
     :param db: Connection to the metadata database
     :type db: sqlite3.Cursor
     :param info: All the metadate for an episode
     :type info: dictionary
-    :param raw: Subtitles in the original format
+    :param raw: Subtitles in the EBU-TT format
     :type raw: string
-    :param trans: Transcript of the video
-    :type trans: string
     :param srt: Subtitles in the SRT format
     :type srt: string
+    :param ids: Cached show and presenter IDs, see :func:`loadIDs`
+    :type ids: dictionary
     '''
+    if ids is None:
+        ids = {}
     try:
         #Check/insert show
-        showID = idOrInsert(db, "shows", "name", info["show"])
+        showID = idOrInsert(db, "shows", "name", info["show"], ids.get("shows"))
     except sqlite3.Error as e:
         sys.exit("ERROR: db error while inserting show \"{}\"".format(e))
     try:
         if "presenter" in info and info["presenter"]:
             #Check/insert presenter
-            presenterID = idOrInsert(db, "presenters", "name", info["presenter"])
+            presenterID = idOrInsert(db, "presenters", "name", info["presenter"], ids.get("presenters"))
         else:
             presenterID = None
     except sqlite3.Error as e:
@@ -346,16 +1694,17 @@ def saveToDB(db, info, raw, trans, srt):
     try:
         if raw:
             #Insert subtitles
-            insert = "INSERT INTO subtitles(raw, transcript, srt) VALUES(?,?,?)"
-            db.execute(insert, (raw, trans, srt))
+            insert = "INSERT INTO subtitles(format, compression, raw) VALUES(?,?,?)"
+            db.execute(insert, ("ebu",) + compressSubtitles(raw))
             subID = db.lastrowid
+            clearSubtitles(subID)
         else:
             subID = None
     except sqlite3.Error as e:
         sys.exit("ERROR: db error while inserting subtitles \"{}\"".format(e))
     try:
         #Insert video info
-        insert = "INSERT INTO videos(datetime, showID, presenterID, subtitleID, topics, note, timstamp, name, articleID, videoID, checksum) VALUES(?,?,?,?,?,?,?,?,?,?,?)"
+        insert = "INSERT INTO videos(datetime, showID, presenterID, subtitleID, topics, note, timstamp, name, articleID, videoID, checksum, downloadChecksum) VALUES(?,?,?,?,?,?,?,?,?,?,?,?)"
         if "note" in info and info["note"]:
             note = info["note"]
         else:
@@ -364,13 +1713,53 @@ def saveToDB(db, info, raw, trans, srt):
             topics = info["topics"]
         else:
             topics = None
-        db.execute(insert, (info["localtime"], showID, presenterID, subID, topics, note, info["timestamp"], info["videoName"], info["articleID"], info["videoID"], info["checksum"]))
+        db.execute(insert, (info["localtime"], showID, presenterID, subID, topics, note, info["timestamp"], info["videoName"], info["articleID"], info["videoID"], info["checksum"], info.get("downloadChecksum")))
+        videoID = db.lastrowid
+        indexEpisode(db, videoID, srt, topics, note)
+        if "chunks" in info:
+            saveChunks(db, videoID, info["chunks"])
+        if "checkLevel" in info:
+            saveCheck(db, videoID, info["checkLevel"], info["checkPassed"])
     except sqlite3.Error as e:
         sys.exit("ERROR: db error while inserting video \"{}\"".format(e))
 # ########################################################################### #
 
 # --------------------------------------------------------------------------- #
-def idOrInsert(db, table, item, data):
+def saveCheck(db, videoID, level, passed):
+    '''Record the result of an integrity check of a video
+
+    :param db: Connection to the metadata database
+    :type db: sqlite3.Cursor
+    :param videoID: ID of the video in the videos table
+    :type videoID: integer
+    :param level: Check level (quick, sample or full)
+    :type level: string
+    :param passed: Whether the check passed
+    :type passed: boolean
+
+    :raises: :class:``sqlite3.Error: Unable to save check result
+    '''
+    db.execute("INSERT OR REPLACE INTO checks(videoID, level, passed, timestamp) VALUES(?,?,?,?);", (videoID, level, int(passed), int(time.time())))
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def loadIDs(db):
+    '''Load the IDs of all shows and presenters
+
+    :param db: Connection to the metadata database
+    :type db: sqlite3.Cursor
+
+    :returns: Dict with the table names as keys and dicts mapping the names to the IDs as values
+    :rtype: dictionary
+    '''
+    ids = {}
+    for table in ["shows", "presenters"]:
+        ids[table] = {name : i for i, name in db.execute("SELECT id, name FROM {};".format(table))}
+    return ids
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def idOrInsert(db, table, item, data, cache=None):
     '''Get the ID of an item in the db table and insert it if it doesn't exist yet
 
     :param db: Connection to the metadata database
@@ -381,16 +1770,22 @@ def idOrInsert(db, table, item, data):
     :type item: string
     :param data: Content of the column which to find (or insert)
     :type data: string
+    :param cache: Dict mapping the content of the column to the ID, updated with inserted items
+    :type cache: dictionary
 
     :returns: ID of the data in the table
     :rtype: integer
     '''
-    cmd = "SELECT id FROM {} WHERE {} = '{}'".format(table, item, data)
-    r = db.execute(cmd).fetchone()
+    if cache is not None and data in cache:
+        return cache[data]
+    cmd = "SELECT id FROM {} WHERE {} = ?".format(table, item)
+    r = db.execute(cmd, (data,)).fetchone()
     if not r:
         insert = "INSERT INTO {}({}) VALUES(?)".format(table, item)
         db.execute(insert, (data,))
         r = [db.lastrowid]
+    if cache is not None:
+        cache[data] = r[0]
     return r[0]
 # ########################################################################### #
 
@@ -534,23 +1929,31 @@ def connectDB(path):
     :rtype: sqlite3.Connection
     '''
     #Connect database
-    dbCon = sqlite3.connect(path)
+    dbCon = sqlite3.connect(path, timeout=DB_TIMEOUT)
+    #Allow concurrent readers (e.g. tsacheck) and only sync at checkpoints
+    dbCon.execute("PRAGMA journal_mode=WAL;")
+    dbCon.execute("PRAGMA synchronous=NORMAL;")
     #Return database connection
     return dbCon
 # ########################################################################### #
 
 # --------------------------------------------------------------------------- #
-def backupDB(con, directory):
-    '''Create a backup copy of the database in the 'backups' subdirectory
+def backupDB(con, directory, keep=BACKUP_KEEP):
+    '''Create a compressed backup copy of the database in the 'backups' subdirectory
+
+    The backup is skipped if the content of the database file didn't change since the last backup.
+    Old backups are pruned according to the retention policy afterwards.
 
     :param con: Connection to the database
     :type con: sqlite3.Connection
     :param directory: Path of the directory in which to store the 'backups' subdirectory with the backups
     :type directory: string
+    :param keep: Number of most recent, daily and weekly backups to keep
+    :type keep: tuple of integers
 
     :raises: :class:``sqlite3.Error: Unable to backup database
 
-    :returns: True if backup successful, otherwise False
+    :returns: True if backup successful or not necessary, otherwise False
     :rtype: boolean
     '''
     timestamp = int(time.time())
@@ -560,36 +1963,191 @@ def backupDB(con, directory):
         os.makedirs(backupDir)
     except OSError:
         pass
+    backupPath = os.path.join(backupDir, "{}.db.zip".format(timestamp))
+    path = con.execute("PRAGMA database_list;").fetchone()[2]
+    con.commit()
+    version = con.execute("PRAGMA data_version;").fetchone()[0]
+    #Move all changes into the database file without waiting for other connections
+    busy, log, checkpointed = con.execute("PRAGMA wal_checkpoint(PASSIVE);").fetchone()
+    #The open read transaction keeps the database file unchanged while reading it
+    con.execute("BEGIN;")
+    try:
+        con.execute("SELECT COUNT(*) FROM sqlite_master;").fetchone()
+        if busy or log != checkpointed or con.execute("PRAGMA data_version;").fetchone()[0] != version:
+            #Another connection is reading an older state or wrote in the meantime, fall back to a copy via the backup API
+            con.rollback()
+            return backupCopy(con, backupDir, timestamp, keep)
+        checksum = hashFile(path)
+        if checksum == lastBackup(backupDir)[1]:
+            print("Database unchanged since last backup")
+            return True
+        #Compress database file while reading it
+        with open(path, "rb") as db, ZipFile(backupPath, 'w', ZIP_DEFLATED) as zipf:
+            with zipf.open("{}.db".format(timestamp), 'w') as f:
+                shutil.copyfileobj(db, f, HASH_BUFFER)
+            zipf.comment = checksum.encode()
+    finally:
+        con.rollback()
+    #Verify zip
+    with ZipFile(backupPath, 'r') as zipf:
+        if zipf.testzip():
+            return False
+    pruneBackups(backupDir, keep)
+    return True
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def backupFile(path, directory, keep=BACKUP_KEEP):
+    '''Create a compressed backup copy of a database with a new connection, see :func:`backupDB`
+
+    :param path: The path of the database
+    :type path: string
+    :param directory: Path of the directory in which to store the 'backups' subdirectory with the backups
+    :type directory: string
+    :param keep: Number of most recent, daily and weekly backups to keep
+    :type keep: tuple of integers
+
+    :raises: :class:``sqlite3.Error: Unable to backup database
+
+    :returns: True if backup successful or not necessary, otherwise False
+    :rtype: boolean
+    '''
+    con = connectDB(path)
+    try:
+        return backupDB(con, directory, keep)
+    finally:
+        con.close()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def backupCopy(con, backupDir, timestamp, keep=BACKUP_KEEP):
+    '''Create a compressed backup copy of the database via a temporary uncompressed copy
+
+    Used by :func:`backupDB` if the database file can't be read directly because it is being written to.
+
+    :param con: Connection to the database
+    :type con: sqlite3.Connection
+    :param backupDir: Path of the directory in which to store the backups
+    :type backupDir: string
+    :param timestamp: Timestamp of the backup
+    :type timestamp: integer
+    :param keep: Number of most recent, daily and weekly backups to keep
+    :type keep: tuple of integers
+
+    :returns: True if backup successful or not necessary, otherwise False
+    :rtype: boolean
+    '''
     #Create db backup
     backupPath = os.path.join(backupDir, "{}.db".format(timestamp))
     bck = sqlite3.connect(backupPath)
     con.backup(bck)
     bck.close()
+    checksum = hashFile(backupPath)
+    if checksum == lastBackup(backupDir)[1]:
+        os.remove(backupPath)
+        print("Database unchanged since last backup")
+        return True
     #Zip backup
     with ZipFile(backupPath + ".zip", 'w') as zipf:
         zipf.write(backupPath, arcname="{}.db".format(timestamp), compress_type=ZIP_DEFLATED)
+        zipf.comment = checksum.encode()
+    #Remove uncompressed backup
+    os.remove(backupPath)
     #Verify zip
     with ZipFile(backupPath + ".zip", 'r') as zipf:
         if zipf.testzip():
             return False
-    #Remove uncompressed backup
-    os.remove(backupPath)
+    pruneBackups(backupDir, keep)
     return True
 # ########################################################################### #
 
 # --------------------------------------------------------------------------- #
-def checkDB(con):
+def listBackups(backupDir):
+    '''Get the timestamps and paths of all backups, newest first
+
+    :param backupDir: Path of the directory with the backups
+    :type backupDir: string
+
+    :returns: List of tuples with the timestamp and the path of each backup
+    :rtype: list
+    '''
+    backups = []
+    for f in os.listdir(backupDir):
+        match = re.match(r"^(\d+)\.db\.zip$", f)
+        if match:
+            backups.append((int(match.group(1)), os.path.join(backupDir, f)))
+    return sorted(backups, reverse=True)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def lastBackup(backupDir):
+    '''Get the path and the database checksum of the newest backup
+
+    :param backupDir: Path of the directory with the backups
+    :type backupDir: string
+
+    :returns: Path of the newest backup and SHA-256 checksum of its database (None if unknown)
+    :rtype: tuple
+    '''
+    backups = listBackups(backupDir)
+    if not backups:
+        return (None, None)
+    path = backups[0][1]
+    try:
+        with ZipFile(path, 'r') as zipf:
+            return (path, zipf.comment.decode() or None)
+    except (OSError, BadZipFile):
+        return (path, None)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def pruneBackups(backupDir, keep=BACKUP_KEEP):
+    '''Remove old backups which are not covered by the retention policy
+
+    The newest backups are kept, as well as the newest backup of each of the last days and weeks.
+
+    :param backupDir: Path of the directory with the backups
+    :type backupDir: string
+    :param keep: Number of most recent, daily and weekly backups to keep
+    :type keep: tuple of integers
+
+    :returns: Paths of the removed backups
+    :rtype: list
+    '''
+    recent, daily, weekly = keep
+    backups = listBackups(backupDir)
+    keepPaths = set(path for _, path in backups[:recent])
+    days = {}
+    weeks = {}
+    for timestamp, path in backups:
+        date = datetime.fromtimestamp(timestamp).date()
+        days.setdefault(date, path)
+        weeks.setdefault(date.isocalendar()[:2], path)
+    keepPaths.update(path for _, path in sorted(days.items(), reverse=True)[:daily])
+    keepPaths.update(path for _, path in sorted(weeks.items(), reverse=True)[:weekly])
+    removed = []
+    for _, path in backups:
+        if path not in keepPaths:
+            os.remove(path)
+            removed.append(path)
+    return removed
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def checkDB(con, full=True):
     '''Check integrity of database
 
     :param con: Connection to the database
     :type con: sqlite3.Connection
+    :param full: Whether to run the full integrity check instead of the quick check without index verification
+    :type full: boolean
 
     :raises: :class:``sqlite3.Error: Unable to check database
 
     :returns: True if check passed, otherwise False
     :rtype: boolean
     '''
-    r = con.execute("pragma integrity_check;")
+    r = con.execute("pragma integrity_check;" if full else "pragma quick_check;")
     res = r.fetchall()
     try:
         return res[0][0] == "ok"
@@ -597,6 +2155,106 @@ def checkDB(con):
         return False
 # ########################################################################### #
 
+# --------------------------------------------------------------------------- #
+def checkDBFile(path):
+    '''Run the full integrity check of a database with a new connection
+
+    :param path: The path of the database
+    :type path: string
+
+    :raises: :class:``sqlite3.Error: Unable to check database
+
+    :returns: True if check passed, otherwise False
+    :rtype: boolean
+    '''
+    con = connectDB(path)
+    try:
+        return checkDB(con)
+    finally:
+        con.close()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def getMaintenance(db, task):
+    '''Get the time of the last run of a maintenance task
+
+    :param db: Connection to the metadata database
+    :type db: sqlite3.Cursor
+    :param task: Name of the task
+    :type task: string
+
+    :returns: Unix timestamp of the last run or None if it never ran
+    :rtype: integer
+    '''
+    try:
+        r = db.execute("SELECT timestamp FROM maintenance WHERE task = ?;", (task,)).fetchone()
+    except sqlite3.OperationalError:
+        #Database not yet updated
+        return None
+    return r[0] if r else None
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def setMaintenance(db, task):
+    '''Record the current time as the last run of a maintenance task
+
+    :param db: Connection to the metadata database
+    :type db: sqlite3.Cursor
+    :param task: Name of the task
+    :type task: string
+    '''
+    db.execute("INSERT OR REPLACE INTO maintenance(task, timestamp) VALUES(?, ?);", (task, int(time.time())))
+    db.connection.commit()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def getSetting(db, name):
+    '''Get a setting stored in the database
+
+    :param db: Connection to the metadata database
+    :type db: sqlite3.Cursor
+    :param name: Name of the setting
+    :type name: string
+
+    :returns: Value of the setting or None if it isn't set
+    :rtype: string
+    '''
+    r = db.execute("SELECT value FROM settings WHERE name = ?;", (name,)).fetchone()
+    return r[0] if r else None
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def setSetting(db, name, value):
+    '''Store a setting in the database
+
+    :param db: Connection to the metadata database
+    :type db: sqlite3.Cursor
+    :param name: Name of the setting
+    :type name: string
+    :param value: Value of the setting
+    :type value: string
+    '''
+    db.execute("INSERT OR REPLACE INTO settings(name, value) VALUES(?, ?);", (name, value))
+    db.connection.commit()
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def printPhase(name, start):
+    '''Print the time elapsed since the start of a phase
+
+    :param name: Name of the phase
+    :type name: string
+    :param start: Start of the phase as returned by :func:`time.perf_counter`
+    :type start: float
+
+    :returns: Current time as the start of the next phase
+    :rtype: float
+    '''
+    now = time.perf_counter()
+    print("{} took {:.2f} s".format(name, now - start))
+    return now
+# ########################################################################### #
+
 # --------------------------------------------------------------------------- #
 def closeDB(dbCon):
     '''Close the connection to a database
@@ -631,13 +2289,14 @@ def createDB(path):
                        name TEXT NOT NULL,
                        articleID INTEGER NOT NULL,
                        videoID TEXT NOT NULL,
-                       checksum TEXT NOT NULL
+                       checksum TEXT NOT NULL,
+                       downloadChecksum TEXT
                    ); """
     subtitleCmd = """ CREATE TABLE IF NOT EXISTS subtitles (
                           id INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE NOT NULL,
-                          raw TEXT NOT NULL,
-                          transcript TEXT NOT NULL,
-                          srt TEXT NOT NULL
+                          format TEXT NOT NULL,
+                          compression TEXT,
+                          raw BLOB NOT NULL
                       ); """
     presenterCmd = """ CREATE TABLE IF NOT EXISTS presenters (
                            id INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE NOT NULL,
@@ -658,10 +2317,212 @@ def createDB(path):
     db.execute(showCmd)
     db.execute(presenterCmd)
     db.execute(subtitleCmd)
+    updateDB(db)
     #Return database connection
     return dbCon
 # ########################################################################### #
 
+# --------------------------------------------------------------------------- #
+def getMigrations():
+    '''Get the schema migrations, each one updates the database to the next schema version
+
+    :returns: The migration functions in the order of the schema versions
+    :rtype: list of functions
+    '''
+    return [migrateTables, migrateIndexes, migrateMaintenance, migrateSubtitles, migrateSearch, migrateSettings]
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def needsUpdate(db):
+    '''Check if the database schema is older than the current version, see :func:`updateDB`
+
+    :param db: Connection to the metadata database
+    :type db: sqlite3.Connection or sqlite3.Cursor
+
+    :returns: True if a migration is pending
+    :rtype: boolean
+    '''
+    return db.execute("PRAGMA user_version;").fetchone()[0] < len(getMigrations())
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def updateDB(db):
+    '''Migrate the database to the current schema version
+
+    The schema version is stored in ``PRAGMA user_version``, each migration runs in its own transaction.
+    The database is compacted afterwards if a migration freed a lot of space.
+
+    :param db: Connection to the metadata database
+    :type db: sqlite3.Connection or sqlite3.Cursor
+
+    :raises: :class:``sqlite3.Error: Unable to update database
+    '''
+    #Migrations commit through the cursor's connection
+    if isinstance(db, sqlite3.Connection):
+        db = db.cursor()
+    migrations = getMigrations()
+    version = db.execute("PRAGMA user_version;").fetchone()[0]
+    vacuum = False
+    for i, migration in enumerate(migrations[version:], version + 1):
+        db.connection.commit()
+        db.execute("BEGIN;")
+        try:
+            #Migrations return True if they freed a lot of space
+            vacuum = migration(db) or vacuum
+            db.execute("PRAGMA user_version = {};".format(i))
+        except sqlite3.Error:
+            db.connection.rollback()
+            raise
+        db.connection.commit()
+    if vacuum:
+        print("Compacting database")
+        db.execute("VACUUM;")
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def migrateTables(db):
+    '''Schema version 1: add columns and tables introduced after the database was created
+
+    :param db: Connection to the metadata database
+    :type db: sqlite3.Cursor
+    '''
+    columns = [r[1] for r in db.execute("PRAGMA table_info(videos);").fetchall()]
+    if "downloadChecksum" not in columns:
+        db.execute("ALTER TABLE videos ADD COLUMN downloadChecksum TEXT;")
+    checkCmd = """ CREATE TABLE IF NOT EXISTS checks (
+                       videoID INTEGER PRIMARY KEY NOT NULL,
+                       level TEXT NOT NULL,
+                       passed INTEGER NOT NULL,
+                       timestamp INTEGER NOT NULL
+                   ); """
+    ledgerCmd = """ CREATE TABLE IF NOT EXISTS ledger (
+                        videoID INTEGER PRIMARY KEY NOT NULL,
+                        size INTEGER NOT NULL,
+                        mtime INTEGER NOT NULL,
+                        inode INTEGER NOT NULL,
+                        verified INTEGER NOT NULL,
+                        level TEXT
+                    ); """
+    scrubCmd = """ CREATE TABLE IF NOT EXISTS scrubs (
+                       id INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE NOT NULL,
+                       timestamp INTEGER NOT NULL,
+                       files INTEGER NOT NULL,
+                       bytes INTEGER NOT NULL
+                   ); """
+    chunkCmd = """ CREATE TABLE IF NOT EXISTS chunks (
+                       videoID INTEGER PRIMARY KEY NOT NULL,
+                       chunkSize INTEGER NOT NULL,
+                       root TEXT NOT NULL,
+                       hashes BLOB NOT NULL
+                   ); """
+    db.execute(checkCmd)
+    db.execute(ledgerCmd)
+    db.execute(scrubCmd)
+    db.execute(chunkCmd)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def migrateIndexes(db):
+    '''Schema version 2: index the videos table and make show and presenter names unique
+
+    Duplicate show and presenter names are merged into the row with the lowest ID first.
+
+    :param db: Connection to the metadata database
+    :type db: sqlite3.Cursor
+    '''
+    for table, column in [("shows", "showID"), ("presenters", "presenterID")]:
+        #Point videos to the first row with the same name and remove the others
+        cmd = """ UPDATE videos SET {1} = (SELECT MIN(b.id) FROM {0} a INNER JOIN {0} b ON a.name = b.name WHERE a.id = videos.{1})
+                  WHERE {1} IN (SELECT id FROM {0} WHERE id NOT IN (SELECT MIN(id) FROM {0} GROUP BY name)); """
+        db.execute(cmd.format(table, column))
+        db.execute("DELETE FROM {0} WHERE id NOT IN (SELECT MIN(id) FROM {0} GROUP BY name);".format(table))
+        db.execute("CREATE UNIQUE INDEX IF NOT EXISTS {0}_name ON {0}(name);".format(table))
+    db.execute("CREATE INDEX IF NOT EXISTS videos_name ON videos(name);")
+    db.execute("CREATE INDEX IF NOT EXISTS videos_show_article ON videos(showID, articleID);")
+    db.execute("CREATE INDEX IF NOT EXISTS videos_videoID ON videos(videoID);")
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def migrateMaintenance(db):
+    '''Schema version 3: add the table with the time of the last run of maintenance tasks
+
+    :param db: Connection to the metadata database
+    :type db: sqlite3.Cursor
+    '''
+    maintenanceCmd = """ CREATE TABLE IF NOT EXISTS maintenance (
+                             task TEXT PRIMARY KEY NOT NULL,
+                             timestamp INTEGER NOT NULL
+                         ); """
+    db.execute(maintenanceCmd)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def migrateSubtitles(db):
+    '''Schema version 4: only store the compressed raw subtitles
+
+    :param db: Connection to the metadata database
+    :type db: sqlite3.Cursor
+
+    :returns: True if existing subtitles were converted
+    :rtype: boolean
+    '''
+    columns = [r[1] for r in db.execute("PRAGMA table_info(subtitles);").fetchall()]
+    if "srt" not in columns:
+        return False
+    subtitleCmd = """ CREATE TABLE subtitles_new (
+                          id INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE NOT NULL,
+                          format TEXT NOT NULL,
+                          compression TEXT,
+                          raw BLOB NOT NULL
+                      ); """
+    db.execute(subtitleCmd)
+    rows = db.connection.execute("SELECT id, raw FROM subtitles;")
+    while True:
+        batch = rows.fetchmany(100)
+        if not batch:
+            break
+        insert = "INSERT INTO subtitles_new(id, format, compression, raw) VALUES(?,?,?,?)"
+        db.executemany(insert, [(i, "ebu") + compressSubtitles(raw) for i, raw in batch])
+    db.execute("DROP TABLE subtitles;")
+    db.execute("ALTER TABLE subtitles_new RENAME TO subtitles;")
+    clearSubtitles()
+    return True
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def migrateSearch(db):
+    '''Schema version 5: add the full-text search index
+
+    The index doesn't store the text itself, existing episodes are added with ``tsasearch.py -u``.
+
+    :param db: Connection to the metadata database
+    :type db: sqlite3.Cursor
+    '''
+    searchCmd = """ CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5(
+                        text, content='', tokenize='unicode61 remove_diacritics 2'
+                    ); """
+    db.execute(searchCmd)
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def migrateSettings(db):
+    '''Schema version 6: add the table with settings, like the cue numbering of the search index
+
+    The cue numbering of an existing index is unknown, so it is only recorded for an empty index
+    (otherwise ``tsasearch.py`` rebuilds the index).
+
+    :param db: Connection to the metadata database
+    :type db: sqlite3.Cursor
+    '''
+    settingsCmd = """ CREATE TABLE IF NOT EXISTS settings (
+                          name TEXT PRIMARY KEY NOT NULL,
+                          value TEXT
+                      ); """
+    db.execute(settingsCmd)
+    if not db.execute("SELECT rowid FROM search LIMIT 1;").fetchone():
+        db.execute("INSERT OR REPLACE INTO settings(name, value) VALUES('searchVersion', ?);", (searchVersion(),))
+# ########################################################################### #
+
 # --------------------------------------------------------------------------- #
 if __name__ == "__main__":
     try:
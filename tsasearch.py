@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+''' tsasearch - Search the transcripts, topics and notes of archived episodes '''
+
+import sys
+import os
+import time
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+import tsarchiver
+
+#Maximum number of episodes to list
+HITS = 20
+#Number of processes converting subtitles when updating the index (None: number of CPUs)
+WORKERS = None
+#Number of episodes to add to the index per transaction
+INDEX_BATCH = 100
+
+# --------------------------------------------------------------------------- #
+def search(argv):
+    '''Search the archive or update its search index
+
+    :param argv: The command line arguments given by the user
+    :type argv: list
+    '''
+    #Get options
+    hits = HITS
+    workers = WORKERS or os.cpu_count() or 1
+    update = False
+    rebuild = False
+    while len(argv) > 1 and argv[1].startswith('-'):
+        opt = argv.pop(1)
+        if opt == '-n':
+            try:
+                hits = max(1, int(argv.pop(1)))
+            except (IndexError, ValueError):
+                sys.exit("ERROR: -n requires a number")
+        elif opt == '-j':
+            try:
+                workers = max(1, int(argv.pop(1)))
+            except (IndexError, ValueError):
+                sys.exit("ERROR: -j requires a number")
+        elif opt == '-u':
+            update = True
+        elif opt == '-r':
+            rebuild = True
+        else:
+            sys.exit("ERROR: Unknown option \"{}\"".format(opt))
+    #Get directory and query
+    try:
+        directory = os.path.normpath(os.path.abspath(argv[1]))
+    except IndexError:
+        directory = os.getcwd()
+    query = " ".join(argv[2:])
+    if not query and not update and not rebuild:
+        print("Usage: tsasearch.py [OPTIONS] ARCHIVEDIR QUERY")
+        return
+
+    dbPath = os.path.join(directory, "archive.db")
+    if not os.path.isfile(dbPath):
+        print("ERROR: No archive database found!")
+        return
+    try:
+        #Connect to database
+        dbCon = tsarchiver.connectDB(dbPath)
+        db = dbCon.cursor()
+        #Migrations can rebuild tables, back up the database first
+        if tsarchiver.needsUpdate(dbCon):
+            print("Backing up database before updating it")
+            if not tsarchiver.backupDB(dbCon, directory):
+                sys.exit("ERROR: Database backup failed")
+        tsarchiver.updateDB(db)
+        #Cue numbers in the index from another conversion or ignore list point to the wrong subtitles
+        if not rebuild and tsarchiver.getSetting(db, "searchVersion") != tsarchiver.searchVersion():
+            print("Subtitle conversion or ignore list changed, rebuilding the index")
+            rebuild = True
+        #Add missing episodes to the index
+        if update or rebuild:
+            start = time.monotonic()
+            count = updateIndex(db, rebuild, workers)
+            elapsed = max(time.monotonic() - start, 1e-6)
+            print("Indexed {} episodes in {:.1f} s".format(count, elapsed))
+        #Search
+        if query:
+            start = time.monotonic()
+            results = searchIndex(db, query, hits)
+            elapsed = time.monotonic() - start
+            for localtime, show, name, begin, text in results:
+                print("{}  {:<4}  {}  {}  {}".format(localtime, show, name, begin or "", text.replace("\n", " ")))
+            print("{} episodes found in {:.3f} s".format(len(results), elapsed))
+        #Close database
+        tsarchiver.closeDB(dbCon)
+    except sqlite3.Error as e:
+        print("ERROR: db error \"{}\"".format(e))
+        return
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def updateIndex(db, rebuild=False, workers=1):
+    '''Add all episodes which are not yet in the search index to it
+
+    :param db: Connection to the metadata database
+    :type db: sqlite3.Cursor
+    :param rebuild: Whether to clear the index and add all episodes again (records the cue numbering, see :func:`tsarchiver.searchVersion`)
+    :type rebuild: boolean
+    :param workers: Number of processes converting the subtitles
+    :type workers: integer
+
+    :returns: Number of indexed episodes
+    :rtype: integer
+    '''
+    if rebuild:
+        db.execute("INSERT INTO search(search) VALUES('delete-all');")
+    #Rows: id, topics, note, subtitle format, compression and data
+    cmd = "SELECT videos.id, videos.topics, videos.note, subtitles.format, subtitles.compression, subtitles.raw FROM videos LEFT JOIN subtitles ON subtitles.id = videos.subtitleID WHERE videos.id = ?;"
+    missing = []
+    for (videoID,) in db.execute("SELECT id FROM videos ORDER BY id;").fetchall():
+        if not db.execute("SELECT rowid FROM search WHERE rowid = ?;", (videoID * tsarchiver.SEARCH_CUES,)).fetchone():
+            missing.append(videoID)
+    count = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for i in range(0, len(missing), INDEX_BATCH):
+            rows = [db.execute(cmd, (videoID,)).fetchone() for videoID in missing[i:i + INDEX_BATCH]]
+            for row, srt in zip(rows, pool.map(deriveSrt, [row[3:] for row in rows])):
+                tsarchiver.indexEpisode(db, row[0], srt, row[1], row[2])
+            db.connection.commit()
+            count += len(rows)
+            print("Indexed {}/{} episodes".format(count, len(missing)))
+    if rebuild:
+        tsarchiver.setSetting(db, "searchVersion", tsarchiver.searchVersion())
+    return count
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def deriveSrt(subtitle):
+    '''Convert stored subtitles to the SRT format
+
+    :param subtitle: Format, compression and data of the stored subtitles (all None if there are none)
+    :type subtitle: tuple
+
+    :returns: Subtitles in the SRT format
+    :rtype: string
+    '''
+    if subtitle[2] is None:
+        return ""
+    return tsarchiver.convertSubtitles(*subtitle)[1]
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+def searchIndex(db, query, hits=HITS):
+    '''Search the index and get the best matching episodes
+
+    The query uses the FTS5 query syntax, if it is invalid its words are searched as plain terms.
+
+    :param db: Connection to the metadata database
+    :type db: sqlite3.Cursor
+    :param query: The search query
+    :type query: string
+    :param hits: Maximum number of episodes to return
+    :type hits: integer
+
+    :returns: Tuples with the date, show, file name, SRT time code of the best matching cue (None for topics and note) and its text, best match first
+    :rtype: list of tuples
+    '''
+    cmd = "SELECT rowid / :cues AS videoID, rowid % :cues AS cue, MIN(rank) AS score FROM search WHERE search MATCH :query GROUP BY videoID ORDER BY score LIMIT :hits;"
+    params = {"cues" : tsarchiver.SEARCH_CUES, "query" : query, "hits" : hits}
+    try:
+        matches = db.execute(cmd, params).fetchall()
+    except sqlite3.OperationalError:
+        #Query syntax error, quote each word
+        params["query"] = " ".join('"{}"'.format(word.replace('"', '""')) for word in query.split())
+        matches = db.execute(cmd, params).fetchall()
+    results = []
+    for videoID, cue, _ in matches:
+        cmd = "SELECT videos.datetime, shows.name, videos.name, videos.subtitleID, videos.topics, videos.note FROM videos INNER JOIN shows ON shows.id = videos.showID WHERE videos.id = ?;"
+        r = db.execute(cmd, (videoID,)).fetchone()
+        if not r:
+            continue
+        begin = None
+        text = "\n".join(t for t in r[4:] if t)
+        subtitles = tsarchiver.getSubtitles(db, r[3]) if cue and r[3] else None
+        if subtitles:
+            #Locate the cue in the subtitles
+            for number, cueBegin, _, cueText in tsarchiver.srtCues(subtitles[1]):
+                if number == cue:
+                    begin = cueBegin
+                    text = cueText
+                    break
+        elif cue:
+            #Subtitles gone since the episode was indexed
+            text = ""
+        results.append((r[0], r[1], r[2], begin, text))
+    return results
+# ########################################################################### #
+
+# --------------------------------------------------------------------------- #
+if __name__ == "__main__":
+    try:
+        search(sys.argv)
+    except KeyboardInterrupt:
+        print("Aborted!")
+# ########################################################################### #